@@ -0,0 +1,68 @@
+import argparse;
+import os;
+import tempfile;
+import phaser;
+
+# usage
+# python2.7 build_het_tables.py --vcf cohort.vcf.gz --cache_dir het_cache --threads 8
+# then run phaser.py for each sample with --cache_dir het_cache and the same variant filter arguments
+
+def main():
+	#Arguments passed
+	parser = argparse.ArgumentParser()
+	# required
+	parser.add_argument("--vcf", help="Cohort VCF, must be gzipped and tabix indexed.", required = True)
+	parser.add_argument("--cache_dir", help="Cache directory to write the heterozygous site tables to, pass the same directory to phaser.py with --cache_dir.", required = True)
+
+	# optional
+	parser.add_argument("--samples", default="", help="Comma separated list of samples to build tables for. If left blank all samples in the VCF are used.")
+	parser.add_argument("--samples_per_pass", type=int, default=50, help="Number of samples whose tables are built in each pass over the VCF. Each thread keeps one open file per sample.")
+	parser.add_argument("--threads", type=int, default=1, help="Maximum number of threads to use, 1 thread per contig.")
+	parser.add_argument("--temp_dir", default="", help="Location of temporary directory to use for storing files. If left blank will default to system temp dir.")
+	parser.add_argument("--max_items_per_thread", type=int, default=100000, help="Maximum number of items that can be assigned to a single thread to process.")
+	parser.add_argument("--show_warning", type=int, default=0, help="Show warnings in stdout (0,1).")
+	parser.add_argument("--debug", type=int, default=0, help="Show debug mode messages (0,1).")
+
+	# must match the phaser.py arguments of the runs that will use the tables
+	parser.add_argument("--haplo_count_blacklist", default="", help="As in phaser.py.")
+	parser.add_argument("--blacklist", default="", help="As in phaser.py.")
+	parser.add_argument("--include_indels", type=int, default=0, help="As in phaser.py.")
+	parser.add_argument("--pass_only", type=int, default=1, help="As in phaser.py.")
+	parser.add_argument("--chr_prefix", type=str, default="", help="As in phaser.py.")
+	parser.add_argument("--gw_phase_method", type=int, default=0, help="As in phaser.py.")
+	parser.add_argument("--gw_af_field", default="AF", help="As in phaser.py.")
+	parser.add_argument("--chr", default="", help="As in phaser.py.")
+	parser.add_argument("--unique_ids", type=int, default=0, help="As in phaser.py.")
+	parser.add_argument("--id_separator", default="_", help="As in phaser.py.")
+	parser.add_argument("--process_slow", type=int, default=0, help="As in phaser.py, tables are stored per contig when set to 1.")
+
+	args = parser.parse_args()
+	phaser.args = args;
+
+	if args.id_separator == ":" or args.id_separator == "":
+		phaser.fatal_error("ID separator must not be ':' or blank. Please choose another separator that is not found in the contig names.");
+	contig_ban = [args.id_separator, ":"];
+
+	if args.temp_dir != "":
+		tempfile.tempdir = args.temp_dir;
+
+	if os.path.isfile(args.vcf) == False:
+		phaser.fatal_error("VCF file does not exist.");
+	elif os.path.isfile(args.vcf+".tbi") == False and os.path.isfile(args.vcf+".csi") == False:
+		phaser.fatal_error("VCF file is not tabix indexed.");
+
+	for xfile in [args.blacklist, args.haplo_count_blacklist]:
+		if xfile != "" and os.path.isfile(xfile) == False:
+			phaser.fatal_error("File: %s not found."%(xfile));
+
+	if args.samples != "":
+		sample_names = args.samples.split(",");
+	else:
+		sample_names = list(phaser.sample_column_map(args.vcf).keys());
+
+	phaser.fun_flush_print("Building heterozygous site tables for %d samples..."%(len(sample_names)));
+	phaser.build_cohort_het_tables(sample_names, args.samples_per_pass, contig_ban);
+	phaser.fun_flush_print("Done.");
+
+if __name__ == "__main__":
+	main();
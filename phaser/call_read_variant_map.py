@@ -3,6 +3,7 @@ import read_variant_map;
 
 # usage
 # samtools view -q 255 -L variants.bed NA06986.2.M_111215_4.bam | python2.7 call_read_variant_map.py
+# results are written as binary records (see read_variant_map.result_dtype) to --o, and the read names to --o.reads
 
 def main():
 	#Arguments passed 
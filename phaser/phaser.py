@@ -9,7 +9,10 @@ import subprocess;
 import itertools;
 import sys;
 import time;
+import array;
 from scipy.stats import binom;
+import scipy.sparse;
+import scipy.sparse.csgraph;
 import numpy;
 import os;
 import pysam;
@@ -19,15 +22,19 @@ import shutil
 import resource
 import glob
 import collections
+import hashlib
+import json
 import datetime
 import io
+import zlib
+import read_variant_map
 
 
 def main():
 	#Arguments passed
 	parser = argparse.ArgumentParser()
 	# required
-	parser.add_argument("--bam", help="Indexed BAMs (comma separated) containing aligned reads", required = False, default='')
+	parser.add_argument("--bam", help="Indexed BAMs or CRAMs (comma separated) containing aligned reads", required = False, default='')
 	parser.add_argument("--vcf", help="VCF for the sample, must be gzipped and tabix indexed.", required = True, default='')
 	parser.add_argument("--sample", help="Sample name in VCF", required = False, default='')
 	parser.add_argument("--mapq", help="Minimum MAPQ for reads to be used for phasing. Can be a comma separated list, each value corresponding to the min MAPQ for a file in the input BAM list. Useful in cases when using both for example DNA and RNA libraries which might have differing mapping qualities.", required = True)
@@ -37,7 +44,7 @@ def main():
 
 
 	# optional
-	parser.add_argument("--python_string", default="python2.7", help="Command that specifies which python2.x interpreter has to be used, required for running read variant mapping script.")
+	parser.add_argument("--python_string", default="python2.7", help="Deprecated, no longer used. Reads are now mapped to variants in process.")
 	parser.add_argument("--haplo_count_bam_exclude", default="", help="Comma separated list of BAMs to exclude when generating haplotypic counts (outputted in o.haplotypic_counts.txt). When left blank haplotypic counts will be generated for all input BAMs, otherwise will they will not be generated for the BAMs specified here. Specify libraries by index where 1 = first library in --bam list, 2 = second, etc...")
 	parser.add_argument("--haplo_count_blacklist", default="", help="BED file containing genomic intervals to be excluded from haplotypic counts. Reads from any variants which lie within these regions will not be counted for haplotypic counts.")
 	parser.add_argument("--cc_threshold", type=float, default=0.01, help="Threshold for significant conflicting variant configuration. The connection between any two variants with a conflicting configuration having p-value lower than this threshold will be removed.")
@@ -47,9 +54,12 @@ def main():
 	parser.add_argument("--write_vcf", type=int, default=1, help="Create a VCF containing phasing information (0,1).")
 	parser.add_argument("--include_indels", type=int, default=0, help="Include indels in the analysis (0,1). NOTE: since mapping is a problem for indels including them will likely result in poor quality phasing unless specific precautions have been taken.")
 	parser.add_argument("--output_read_ids", type=int, default=0, help="Output read IDs in the coverage files (0,1).")
-	parser.add_argument("--remove_dups", type=int, default=1, help="Remove duplicate reads from all analyses (0,1).")
+	parser.add_argument("--remove_dups", type=int, default=1, help="Remove duplicate reads from all analyses (0,1,2). 1 = remove reads flagged as duplicates. 2 = also detect duplicates that have not been flagged while mapping reads.")
 	parser.add_argument("--pass_only", type=int, default=1, help="Only use variants labled with PASS in the VCF filter field (0,1).")
+	parser.add_argument("--long_read", type=int, default=0, help="Reads are long reads spanning many variants, for example PacBio or ONT (0,1). If enabled variants are only connected to those within --long_read_window of them on each read.")
+	parser.add_argument("--long_read_window", type=int, default=1, help="In long read mode, the number of following variants on a read that each variant is connected to. 1 = only connect variants that are adjacent on the read. Set to 0 to connect all variants on the read.")
 	parser.add_argument("--unphased_vars", type=int, default=1, help="Output unphased variants (singletons) in the haplotypic_counts and haplotypes files (0,1).")
+	parser.add_argument("--reference", type=str, default="", help="Indexed FASTA reference used to decode CRAM input files. If left blank the reference given in the CRAM header is used.")
 	parser.add_argument("--chr_prefix", type=str, default="", help="Add the string to the begining of the VCF contig name. For example set to 'chr' if VCF contig is listed as '1' and bam reference is 'chr1'.")
 
 	# genome wide phasing
@@ -59,10 +69,13 @@ def main():
 	parser.add_argument("--gw_phase_vcf_min_confidence", type=float, default=0.90, help="If replacing GT field in VCF, only replace when phASER haplotype gw_confidence >= this value.")
 
 	# performance
-	parser.add_argument("--threads", type=int, default=1, help="Maximum number of threads to use. Note the maximum thread count for some tasks is bounded by the data (for example 1 thread per contig for haplotype construction).")
+	parser.add_argument("--threads", type=int, default=1, help="Maximum number of threads to use. Note the maximum thread count for some tasks is bounded by the data (for example 1 thread per contig for heterozygous site extraction and haplotype construction).")
 	parser.add_argument("--max_block_size", type=int, default=15, help="Maximum number of variants to phase at once. Number of haplotypes tested = 2 ^ # variants in block. Blocks larger than this will be split into sub blocks, phased, and then the best scoring sub blocks will be phased with each other.")
 	parser.add_argument("--temp_dir", default="", help="Location of temporary directory to use for storing files. If left blank will default to system temp dir. NOTE: potentially large files will be stored in this directory, so please ensure there is sufficient free space.")
 	parser.add_argument("--max_items_per_thread", type=int, default=100000, help="Maximum number of items that can be assigned to a single thread to process. NOTE: if this number is too high Python will stall when trying to join the pools.")
+	parser.add_argument("--max_variant_depth", type=int, default=0, help="Maximum number of reads kept for each variant. Variants covered by more reads are downsampled, keeping exact read counts in o.allelic_counts.txt. Set to 0 for no maximum.")
+	parser.add_argument("--cache_dir", default="", help="Directory used to cache the heterozygous site tables generated from the VCF. Runs with the same VCF, sample and variant filters reuse the cached tables instead of reading the VCF again. If left blank no cache is used.")
+	parser.add_argument("--shard_size", type=int, default=0, help="Maximum number of heterozygous sites in a read mapping shard. Contigs with more sites are split into position windows which are mapped in parallel. If set to 0 the shard size is chosen based on the number of sites and --threads.")
 
 	# debug / development / reporting
 	parser.add_argument("--show_warning", type=int, default=0, help="Show warnings in stdout (0,1).")
@@ -94,10 +107,8 @@ def main():
 	devnull = open(os.devnull, 'w')
 
 	# check for external dependencies
-	if check_dependency("samtools") == False: fatal_error("External dependency 'samtools' not installed.");
 	if check_dependency("bgzip") == False: fatal_error("External dependency 'bgzip' not installed.");
 	if check_dependency("tabix") == False: fatal_error("External dependency 'tabix' not installed.");
-	if check_dependency("bedtools") == False: fatal_error("External dependency 'bedtools' not installed.");
 	if check_dependency("bcftools") == False: fatal_error("External dependency 'bcftools' not installed.");
 
 
@@ -187,10 +198,19 @@ def parse_sample(sample_name, map_sample_column, bam_file, sample_out_path, cont
 		if xfile != "":
 			if os.path.isfile(xfile) == False:
 				fatal_error("File: %s not found." % (xfile));
-			if os.path.isfile(xfile + ".bai") == False and os.path.isfile(xfile.replace(".bam", ".bai")) == False:
+			if xfile.endswith(".cram"):
+				if os.path.isfile(xfile + ".crai") == False and os.path.isfile(xfile.replace(".cram", ".crai")) == False:
+					fatal_error(
+						"Index for CRAM %s not found. CRAM files must be indexed, with naming 'sample.cram.crai'." % (xfile));
+				if args.reference == "":
+					print_warning("No --reference supplied for CRAM %s, the reference given in the CRAM header will be used."%(xfile));
+			elif os.path.isfile(xfile + ".bai") == False and os.path.isfile(xfile.replace(".bam", ".bai")) == False and os.path.isfile(xfile + ".csi") == False:
 				fatal_error(
 					"Index for BAM %s not found. BAM files must be indexed, with naming 'sample.bam.bai'." % (xfile));
 
+	if args.reference != "" and os.path.isfile(args.reference) == False:
+		fatal_error("Reference %s not found." % (args.reference));
+
 	global sample_column
 	#start_time = time.time()
 
@@ -200,66 +220,38 @@ def parse_sample(sample_name, map_sample_column, bam_file, sample_out_path, cont
 		fatal_error("Sample '%s' not found in the input VCF file." % (sample_name));
 
 
-	# filter blacklisted variants if necessary, cut only sample column, filter for heterozygous sites
-	# decompress for intersection
-	if args.chr != "":
-		fun_flush_print("    restricting to chromosome '%s'..." % (args.chr));
-		decomp_str = "tabix -h "+args.vcf+" "+args.chr+":"
-	else:
-		fun_flush_print("    using all the chromosomes ...");
-		decomp_str = "gunzip -c "+args.vcf;
-
-	## create a temporary file to store the VCF data
-	vcf_out = tempfile.NamedTemporaryFile(delete=False);
-	vcf_out.close();
-	vcf_path = vcf_out.name;
-
-
+	# load blacklist intervals, variants are filtered against them while reading the VCF
+	blacklist = None;
 	if args.blacklist != "":
-		fun_flush_print("    removing blacklisted variants and processing VCF...");
-		call_str = decomp_str + " | cut -f 1-9,"+str(sample_column+1)+" | grep -v '0|0\|1|1' | bedtools intersect -header -v -a stdin -b "+args.blacklist+" > "+vcf_out.name;
-		error_code = subprocess.check_call("set -euo pipefail && "+call_str,shell=True, executable='/bin/bash',stderr=devnull)
-	else:
-		fun_flush_print("    processing VCF...");
-		call_str = decomp_str + " | cut -f 1-9,"+str(sample_column+1)+" | grep -v '0|0\|1|1' > "+vcf_out.name;
-		error_code = subprocess.check_call("set -euo pipefail && "+call_str,shell=True, executable='/bin/bash')
+		fun_flush_print("    loading blacklist intervals...");
+		blacklist = load_bed_intervals(args.blacklist);
 
-	if error_code != 0:
-		fatal_error("VCF filtering using subprocess.call \""+call_str+"\" exited with an error")
-
-	# generate blacklisted variant list
-	set_haplo_blacklist = [];
+	haplo_blacklist = None;
 	if args.haplo_count_blacklist != "":
 		fun_flush_print("#1b. Loading haplotypic count blacklist intervals...");
-		raw_interval = subprocess.check_output("set -euo pipefail && "+"bedtools intersect -a "+vcf_path+" -b "+args.haplo_count_blacklist+" | cut -f 1-2", shell=True, executable='/bin/bash')
-		for line in raw_interval.split("\n"):
-			columns = line.replace("\n","").split("\t");
-			if len(columns) > 1:
-				xchr = columns[0];
-				if args.chr == "" or args.chr == xchr:
-					pos = int(columns[1]);
-					set_haplo_blacklist.append(xchr+"_"+str(pos));
-
-	set_haplo_blacklist = set(set_haplo_blacklist);
+		haplo_blacklist = load_bed_intervals(args.haplo_count_blacklist);
 
 	# storing the string value of original output prefix (i.e args.o)
 	#org_outprefix = copy.copy(args.o)
 	org_outprefix = copy.copy(sample_out_path)
 	fun_flush_print('')
 
-	#stream_vcf = open(vcf_path, "r")
 	if args.process_slow == 0:
 		'''loads "all reads" from bam file (from all chromosome/contigs) in to the memory. 
 		This is good when the computer RAM is big.'''
 		print('    Memory efficient mode is deactivated...\n'
 			  '    If RAM is limited, activate memory efficient mode using the flag "--process_slow = 1"...\n')
-		#stream_vcf = gzip.open(args.vcf) ;
-		stream_vcf = open(vcf_path, "r")
 		chr_of_interest = args.chr
 		start_time = time.time()
 
-		process_vcf(stream_vcf, chr_of_interest, contig_ban, set_haplo_blacklist,
-					start_time, vcf_out, sample_out_path, last_chr=True, pi_block_value = 0)
+		if chr_of_interest != "":
+			fun_flush_print("    restricting to chromosome '%s'..." % (chr_of_interest));
+			het_tables = het_site_tables([chr_of_interest], contig_ban, blacklist, haplo_blacklist);
+		else:
+			fun_flush_print("    using all the chromosomes ...");
+			het_tables = het_site_tables(None, contig_ban, blacklist, haplo_blacklist);
+
+		process_vcf(het_tables, chr_of_interest, start_time, sample_out_path, pi_block_value = 0)
 
 	elif args.process_slow == 1:
 		'''processes reads from each contig/chromosome separately. 
@@ -270,12 +262,10 @@ def parse_sample(sample_name, map_sample_column, bam_file, sample_out_path, cont
 
 		## prepare the list of the contig/chromosome names in the input VCF
 		if args.chr == '':
-			# if original args.chr was empty, use all the chromosomes
-			argu0 = ["tabix -l " + args.vcf]
-			process_col0 = subprocess.Popen(argu0, stdout=subprocess.PIPE,
-											stderr=subprocess.PIPE, shell=True, executable='/bin/bash')
-			uniq_chr = process_col0.communicate()[0]
-			chr_of_interest = uniq_chr.rstrip('\n').split("\n")
+			# if original args.chr was empty, use all the chromosomes listed in the VCF index
+			stream_vcf = pysam.TabixFile(args.vcf);
+			chr_of_interest = list(stream_vcf.contigs);
+			stream_vcf.close();
 			print('    %s unique contigs/chromosomes found... ' %(len(chr_of_interest)))
 
 		elif args.chr != '':
@@ -289,36 +279,47 @@ def parse_sample(sample_name, map_sample_column, bam_file, sample_out_path, cont
 		global pi_block_value
 		pi_block_value = 0
 
+		# contigs that are skipped are written to the VCF without any phased haplotypes
+		global haplotype_lookup
+
 		## Now, process each contig/chromosome separately on a for loop
 		print('    Running processes for each chromosome separately...\n')
-		for nth, unq_chr in enumerate(chr_of_interest):
-			if nth == len(chr_of_interest)-1:
-				last_chr = True
-			else: last_chr = False
-
-			# open the input vcf in each loop.
-				# ** for future: this can be avoided by splitting the VCF file,
-				# and may also reduce the run time.
-				# see this example: https://www.biostars.org/p/173073/
-			stream_vcf = open(vcf_path, "r")
-
+		processed_chr = [];
+		merged_chr = [];
+		for unq_chr in chr_of_interest:
 			# name the output as : arg.o + contig name.
-			# ** for future: this may also be stored as a temporary file
 			sample_out_path_by_chr = org_outprefix + unq_chr
 			start_time = time.time()
 
-			# now, pass the data to the required procedure/function
-			process_vcf(stream_vcf, unq_chr, contig_ban,
-						set_haplo_blacklist, start_time, vcf_out,
-						sample_out_path_by_chr, last_chr, pi_block_value)
+			# only the records of this contig are read from the VCF through its index
+			het_tables = het_site_tables([unq_chr], contig_ban, blacklist, haplo_blacklist);
+
+			# contigs without any usable heterozygous site (e.g. decoys) are not phased
+			# their records are still written to the VCF as unphased, as they are when all contigs are processed at once
+			if sum([x[1] for x in het_tables[0]]) == 0:
+				fun_flush_print("     no heterozygous sites used for phasing on chromosome '%s', skipping..." %(unq_chr));
+				if args.cache_dir == "":
+					for table in het_tables[0]:
+						os.remove(table[3]);
+				if args.write_vcf == 1:
+					haplotype_lookup = collections.OrderedDict();
+					write_vcf(sample_out_path_by_chr, unq_chr);
+					merged_chr.append(unq_chr);
+				continue;
 
-			# pause the loop briefly for few secs (to allow some time/room for optimization purposes)
-			time.sleep(1.5)
+			# now, pass the data to the required procedure/function
+			process_vcf(het_tables, unq_chr, start_time,
+						sample_out_path_by_chr, pi_block_value)
+			processed_chr.append(unq_chr);
+			merged_chr.append(unq_chr);
 			fun_flush_print('')
 
+		if len(processed_chr) == 0:
+			fatal_error("No heterozygous sites that passed all filters were included in the analysis, phASER cannot continue. Check blacklist and pass_only arguments.");
+
 		## After the above for-loop process is complete, merge the data for several contigs/chromosomes
 		# This is only active in "process_slow = 1" mode.
-		merge_files(chr_of_interest, org_outprefix, sample_name)
+		merge_files(merged_chr, org_outprefix, sample_name)
 
 # this is only active in "process_slow = 1" mode.
 def merge_files(chr_of_interest, org_outprefix, sample_name):
@@ -372,87 +373,444 @@ def merge_files(chr_of_interest, org_outprefix, sample_name):
 		os.remove(names)
 
 
+'''Returns the variant mapping tables of the heterozygous sites for all contigs or only those given.
+   If --cache_dir is set tables are reused from earlier runs with the same VCF, sample and filters. '''
+def het_site_tables(contigs, contig_ban, blacklist, haplo_blacklist):
+	cache_path = "";
+	if args.cache_dir != "":
+		cache_path = os.path.join(args.cache_dir, het_table_cache_key(args.sample, contigs));
+		if os.path.isfile(os.path.join(cache_path, "manifest.json")):
+			fun_flush_print("    using cached heterozygous site tables from %s..."%(cache_path));
+			return(load_het_table_cache(cache_path));
+
+	het_tables = load_het_sites(contigs, contig_ban, blacklist, haplo_blacklist);
+	if cache_path != "":
+		save_het_table_cache(cache_path, args.sample, het_tables);
+
+	return(het_tables);
+
+def het_table_cache_key(sample_name, contigs):
+	# changes whenever the table layout changes, so tables from older versions are not reused
+	het_table_format = 2;
+
+	# everything the tables depend on, input files are identified by path, size and modification time
+	settings = [het_table_format, file_signature(args.vcf), sample_name, args.pass_only, args.include_indels,
+				file_signature(args.blacklist), file_signature(args.haplo_count_blacklist), args.chr_prefix,
+				args.unique_ids, args.id_separator, args.gw_phase_method, args.gw_af_field, contigs];
+
+	return(hashlib.md5(json.dumps(settings).encode("utf-8")).hexdigest());
+
+def file_signature(path):
+	if path == "":
+		return("");
+	file_stat = os.stat(path);
+	return([os.path.abspath(path), file_stat.st_size, int(file_stat.st_mtime)]);
+
+def load_het_table_cache(cache_path):
+	stream_in = open(os.path.join(cache_path, "manifest.json"), "r");
+	manifest = json.load(stream_in);
+	stream_in.close();
+
+	tables = [];
+	for chrom, het_count, indels_excluded, table_name in manifest['tables']:
+		spans = numpy.load(os.path.join(cache_path, table_name+".spans.npy"));
+		tables.append([str(chrom), het_count, indels_excluded, os.path.join(cache_path, table_name+".txt"), spans]);
+
+	return([tables, manifest['total_sites'], manifest['filter_count'], manifest['unphased_count'], manifest['blacklist_count']]);
+
+def save_het_table_cache(cache_path, sample_name, het_tables):
+	tables, total_sites, filter_count, unphased_count, blacklist_count = het_tables;
+
+	# the entry is written to a staging directory and renamed into place, so readers never see a partial entry
+	if os.path.isdir(args.cache_dir) == False:
+		os.makedirs(args.cache_dir);
+	staging_path = tempfile.mkdtemp(dir=args.cache_dir, prefix=".staging_");
+	os.chmod(staging_path, 0o755);
+
+	manifest_tables = [];
+	for index, table in enumerate(tables):
+		table_name = str(index);
+		shutil.move(table[3], os.path.join(staging_path, table_name+".txt"));
+		numpy.save(os.path.join(staging_path, table_name+".spans.npy"), table[4]);
+		manifest_tables.append([table[0], table[1], table[2], table_name]);
+		table[3] = os.path.join(cache_path, table_name+".txt");
+
+	manifest = collections.OrderedDict([("vcf", os.path.abspath(args.vcf)), ("sample", sample_name),
+		("total_sites", total_sites), ("filter_count", filter_count), ("unphased_count", unphased_count),
+		("blacklist_count", blacklist_count), ("tables", manifest_tables)]);
+
+	stream_out = open(os.path.join(staging_path, "manifest.json"), "w");
+	json.dump(manifest, stream_out, indent=1);
+	stream_out.close();
+
+	try:
+		os.rename(staging_path, cache_path);
+	except OSError:
+		# another run stored the same entry first
+		shutil.rmtree(staging_path);
+
+'''Builds the het site table cache entries for many samples of a cohort VCF, see build_het_tables.py.
+   Each contig is read once per group of samples instead of once per sample. '''
+def build_cohort_het_tables(sample_names, samples_per_pass, contig_ban):
+	map_sample_column = sample_column_map(args.vcf);
+	for sample_name in sample_names:
+		if sample_name not in map_sample_column:
+			fatal_error("Sample '%s' not found in the input VCF file." % (sample_name));
+
+	blacklist = None;
+	if args.blacklist != "":
+		blacklist = load_bed_intervals(args.blacklist);
+
+	haplo_blacklist = None;
+	if args.haplo_count_blacklist != "":
+		haplo_blacklist = load_bed_intervals(args.haplo_count_blacklist);
+
+	# contigs are grouped the same way phaser will look them up in the cache
+	stream_vcf = pysam.TabixFile(args.vcf);
+	if args.process_slow == 1 and args.chr != "":
+		contigs = args.chr.split(",");
+	elif args.chr != "":
+		contigs = [args.chr];
+	else:
+		contigs = list(stream_vcf.contigs);
+	contigs_present = [xchr for xchr in contigs if xchr in stream_vcf.contigs];
+	stream_vcf.close();
+
+	for xchr in contigs_present:
+		check_contig_name(xchr, contig_ban);
+
+	for group_start in range(0, len(sample_names), samples_per_pass):
+		group = sample_names[group_start:group_start+samples_per_pass];
+		fun_flush_print("     processing samples %d to %d of %d..."%(group_start+1, group_start+len(group), len(sample_names)));
+
+		pool_input = [];
+		for xchr in contigs_present:
+			chrom_blacklist = blacklist.get(xchr) if blacklist != None else None;
+			chrom_haplo_blacklist = haplo_blacklist.get(xchr) if haplo_blacklist != None else None;
+			pool_input.append([xchr, [map_sample_column[x] for x in group], chrom_blacklist, chrom_haplo_blacklist]);
+
+		pool_output = parallelize(generate_cohort_mapping_tables, pool_input);
+
+		for sample_index, sample_name in enumerate(group):
+			# per contig [table, total sites, filtered, unphased, blacklisted]
+			sample_tables = [x[sample_index] for x in pool_output];
+
+			if args.process_slow == 1:
+				entries = [[[xchr], [x]] for xchr, x in zip(contigs_present, sample_tables)];
+			elif args.chr != "":
+				entries = [[contigs, sample_tables]];
+			else:
+				entries = [[None, sample_tables]];
+
+			for entry_contigs, entry_tables in entries:
+				het_tables = [[x[0] for x in entry_tables], sum([x[1] for x in entry_tables]), sum([x[2] for x in entry_tables]),
+							  sum([x[3] for x in entry_tables]), sum([x[4] for x in entry_tables])];
+
+				cache_path = os.path.join(args.cache_dir, het_table_cache_key(sample_name, entry_contigs));
+				if os.path.isfile(os.path.join(cache_path, "manifest.json")):
+					for x in entry_tables:
+						os.remove(x[0][3]);
+				else:
+					save_het_table_cache(cache_path, sample_name, het_tables);
+
+def generate_cohort_mapping_tables(input):
+	chr = input[0];
+	sample_columns = input[1];
+	chrom_blacklist = input[2];
+	chrom_haplo_blacklist = input[3];
+
+	chrom = args.chr_prefix + chr;
+
+	# rows are written out while reading, so memory does not grow with the number of samples
+	mapper_outs = [tempfile.NamedTemporaryFile(delete=False, mode='wt') for x in sample_columns];
+	spans = [array.array('l') for x in sample_columns];
+	het_counts = [0] * len(sample_columns);
+	indel_counts = [0] * len(sample_columns);
+	site_counts = [0] * len(sample_columns);
+	filter_counts = [0] * len(sample_columns);
+	unphased_counts = [0] * len(sample_columns);
+	blacklist_counts = [0] * len(sample_columns);
+
+	max_split = max(sample_columns) + 1;
+	format_string = None;
+	gt_index = -1;
+
+	stream_vcf = pysam.TabixFile(args.vcf);
+	for line in stream_vcf.fetch(chr):
+		vcf_columns = line.split("\t", max_split);
+
+		if vcf_columns[8] != format_string:
+			format_string = vcf_columns[8];
+			fields = format_string.split(":");
+			gt_index = fields.index("GT") if "GT" in fields else -1;
+
+		if gt_index == -1:
+			print_warning("Genotype, defined by GT not found in input VCF for variant %s."%(vcf_columns[2]));
+			continue;
+
+		# filters that do not depend on the sample are only evaluated once per site
+		variant_start = int(vcf_columns[1]) - 1;
+		variant_stop = variant_start + len(vcf_columns[3]);
+		blacklisted = interval_overlap(chrom_blacklist, variant_start, variant_stop);
+		passed = args.pass_only == 0 or "PASS" in vcf_columns[6].split(";");
+		haplo_blacklisted = bool(interval_overlap(chrom_haplo_blacklist, variant_start, variant_stop));
+
+		for index, column in enumerate(sample_columns):
+			het_genotype = heterozygous_genotype(vcf_columns[column], gt_index);
+			if het_genotype == None:
+				continue;
+			geno_string, xgeno, unphased = het_genotype;
+
+			if blacklisted:
+				blacklist_counts[index] += 1;
+				continue;
+			if passed == False:
+				filter_counts[index] += 1;
+				continue;
+
+			site_counts[index] += 1;
+			if unphased == True:
+				unphased_counts[index] += 1;
+
+			row = mapping_table_row(chrom, vcf_columns, geno_string, xgeno, haplo_blacklisted);
+			if row != None:
+				spans[index].extend((variant_start, variant_stop, mapper_outs[index].tell()));
+				mapper_outs[index].write(row);
+				het_counts[index] += 1;
+			else:
+				indel_counts[index] += 1;
+
+	stream_vcf.close();
+
+	output = [];
+	for index in range(len(sample_columns)):
+		mapper_outs[index].close();
+		table = [chrom, het_counts[index], indel_counts[index], mapper_outs[index].name, numpy.array(spans[index], dtype=numpy.int64).reshape(-1, 3)];
+		output.append([table, site_counts[index], filter_counts[index], unphased_counts[index], blacklist_counts[index]]);
+
+	return(output);
+
+'''Creates the variant mapping tables of the heterozygous sites of the input sample, for all contigs or only those given.
+   Contigs are read in parallel through the VCF index, each is filtered for PASS and the blacklist
+   and written to its mapping table in the same pass, no intermediate VCF is written. '''
+def load_het_sites(contigs, contig_ban, blacklist, haplo_blacklist):
+	stream_vcf = pysam.TabixFile(args.vcf);
+	if contigs == None:
+		contigs = list(stream_vcf.contigs);
+	else:
+		contigs = [xchr for xchr in contigs if xchr in stream_vcf.contigs];
+	stream_vcf.close();
+
+	pool_input = [];
+	for xchr in contigs:
+		check_contig_name(xchr, contig_ban);
+		chrom_blacklist = blacklist.get(xchr) if blacklist != None else None;
+		chrom_haplo_blacklist = haplo_blacklist.get(xchr) if haplo_blacklist != None else None;
+		pool_input.append([xchr, chrom_blacklist, chrom_haplo_blacklist]);
+
+	fun_flush_print("     creating variant mapping table...");
+	pool_output = parallelize(load_contig_het_sites, pool_input);
+
+	# per contig [table, total sites, filtered, unphased, blacklisted]
+	tables = [x[0] for x in pool_output];
+	total_sites = sum([x[1] for x in pool_output]);
+	filter_count = sum([x[2] for x in pool_output]);
+	unphased_count = sum([x[3] for x in pool_output]);
+	blacklist_count = sum([x[4] for x in pool_output]);
+
+	return([tables, total_sites, filter_count, unphased_count, blacklist_count]);
+
+def load_contig_het_sites(input):
+	global sample_column;
+
+	chr = input[0];
+	chrom_blacklist = input[1];
+	chrom_haplo_blacklist = input[2];
+
+	chrom = args.chr_prefix + chr;
+
+	# only the rows of the mapping table are sent back to the parent, as a temporary file
+	mapper_out = tempfile.NamedTemporaryFile(delete=False, mode='wt');
+	# [start, stop, table offset] of each site, used to split the table into read mapping shards
+	spans = array.array('l');
+	het_count = 0;
+	indel_count = 0;
+
+	het_candidates = [];
+	site_count = 0;
+	filter_count = 0;
+	unphased_count = 0;
+	blacklist_count = 0;
+
+	# only split the line up to the sample column, the columns of all other samples are never decoded
+	max_split = sample_column + 1;
+	format_string = None;
+	gt_index = -1;
+
+	stream_vcf = pysam.TabixFile(args.vcf);
+	for line in stream_vcf.fetch(chr):
+		vcf_columns = line.split("\t", max_split);
+
+		# the GT index only needs to be found again when the format changes
+		if vcf_columns[8] != format_string:
+			format_string = vcf_columns[8];
+			fields = format_string.split(":");
+			gt_index = fields.index("GT") if "GT" in fields else -1;
+
+		if gt_index == -1:
+			print_warning("Genotype, defined by GT not found in input VCF for variant %s."%(vcf_columns[2]));
+			continue;
+
+		het_genotype = heterozygous_genotype(vcf_columns[sample_column], gt_index);
+		if het_genotype != None:
+			het_candidates.append([vcf_columns, het_genotype]);
+
+	stream_vcf.close();
+
+	# blacklists are tested for all sites of the contig at once
+	variant_starts = numpy.array([int(x[0][1]) - 1 for x in het_candidates], dtype=numpy.int64);
+	variant_stops = variant_starts + numpy.array([len(x[0][3]) for x in het_candidates], dtype=numpy.int64);
+	blacklisted = interval_overlap(chrom_blacklist, variant_starts, variant_stops).tolist();
+	haplo_blacklisted = interval_overlap(chrom_haplo_blacklist, variant_starts, variant_stops).tolist();
+
+	for index, (vcf_columns, het_genotype) in enumerate(het_candidates):
+		geno_string, xgeno, unphased = het_genotype;
+
+		if blacklisted[index]:
+			blacklist_count += 1;
+			continue;
+
+		filters = vcf_columns[6].split(";");
+		if args.pass_only == 0 or "PASS" in filters:
+			site_count += 1;
+			if unphased == True:
+				unphased_count += 1;
+
+			row = mapping_table_row(chrom, vcf_columns, geno_string, xgeno, haplo_blacklisted[index]);
+			if row != None:
+				spans.extend((int(variant_starts[index]), int(variant_stops[index]), mapper_out.tell()));
+				mapper_out.write(row);
+				het_count += 1;
+			else:
+				indel_count += 1;
+		else:
+			filter_count += 1;
+
+	mapper_out.close();
+
+	table = [chrom, het_count, indel_count, mapper_out.name, numpy.array(spans, dtype=numpy.int64).reshape(-1, 3)];
+	return([table, site_count, filter_count, unphased_count, blacklist_count]);
+
+def heterozygous_genotype(sample_field, gt_index):
+	# returns [GT string, alleles, unphased] if the sample is heterozygous, otherwise None
+	geno_string = sample_field.split(":")[gt_index];
+	xgeno = list(geno_string);
+	if "." in xgeno:
+		return(None);
+
+	unphased = False;
+	if "|" in xgeno: xgeno.remove("|");
+	if "/" in xgeno:
+		xgeno.remove("/");
+		unphased = True;
+
+	if len(set(xgeno)) < 2:
+		return(None);
+
+	return([geno_string, xgeno, unphased]);
+
+def check_contig_name(xchr, contig_ban):
+	for item in contig_ban:
+		if item in xchr:
+			fatal_error("Character '%s' must not be present in contig name. "
+						"Please change id separtor using --id_separator to a character not "
+						"found in the contig names and try again."%(item));
+
+def load_bed_intervals(path):
+	# returns merged BED intervals per contig as [starts, stops] lists sorted by position
+	if path.endswith(".gz"):
+		stream_in = gzip.open(path, "rt");
+	else:
+		stream_in = open(path, "r");
+
+	raw_intervals = collections.OrderedDict()
+	for line in stream_in:
+		if line.startswith("#") or line.startswith("track") or line.startswith("browser"):
+			continue;
+		columns = line.rstrip("\n").split("\t");
+		if len(columns) < 3:
+			continue;
+		if columns[0] not in raw_intervals:
+			raw_intervals[columns[0]] = [];
+		raw_intervals[columns[0]].append((int(columns[1]), int(columns[2])));
+
+	stream_in.close();
+
+	intervals = {};
+	for xchr in raw_intervals:
+		starts = [];
+		stops = [];
+		for start, stop in sorted(raw_intervals[xchr]):
+			if len(stops) > 0 and start <= stops[-1]:
+				stops[-1] = max([stops[-1], stop]);
+			else:
+				starts.append(start);
+				stops.append(stop);
+		intervals[xchr] = [numpy.array(starts, dtype=numpy.int64), numpy.array(stops, dtype=numpy.int64)];
+
+	return(intervals);
+
+def interval_overlap(intervals, starts, stops):
+	# returns whether each [start, stop) overlaps an interval, works on single positions or arrays
+	# intervals are merged, so only the first one ending after start can overlap
+	if intervals == None or len(intervals[1]) == 0:
+		return(numpy.zeros(numpy.shape(starts), dtype=bool));
+	index = numpy.searchsorted(intervals[1], starts, side='right');
+	return((index < len(intervals[1])) & (intervals[0][numpy.minimum(index, len(intervals[1]) - 1)] < stops));
+
 '''This function processes vcf for the input sample. If memory_efficient mode is activated, 
    VCF for each chromosome/scaffold would be passed one by one into this function, 
    if not all the VCF data will be passed at once. '''
-def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
-				start_time, vcf_out, out_prefix, last_chr, pi_block_value):
+def process_vcf(het_tables, chromosome, start_time, out_prefix, pi_block_value):
 	chrom_of_interest = chromosome
-	mapper_out = tempfile.NamedTemporaryFile(delete=False);
-	bed_out = tempfile.NamedTemporaryFile(delete=False);
 	het_count = 0;
 	total_indels_excluded = 0;
-	unphased_count = 0;
 
 	if args.process_slow == 1:
 		fun_flush_print("     \nprocessing chromosome '%s' ..." %(chromosome))
 
-	fun_flush_print("     creating variant mapping table...");
-
-	gt_index = -1;
-	chromosome_pool = collections.OrderedDict()
-	filter_count = 0;
-
-	for line in stream_vcf:
-		vcf_columns = line.rstrip('\n').split("\t");
-		if line.startswith("#") == False:
-			#1       10177   .       A       AC      100     PASS    AC=2130;AF=0.425319;AN=5008;NS=2504;DP=103152;EAS_AF=0.3363;AMR_AF=0.3602;AFR_AF=0.4909;EUR_AF=0.4056;SAS_AF=0.4949;AA=|||unknown(NO_COVERAGE)  GT      1|0
-			unphased = False;
-			chr = vcf_columns[0];
-			for item in contig_ban:
-				if item in chr:
-					fatal_error("Character '%s' must not be present in contig name. "
-								"Please change id separtor using --id_separator to a character not "
-								"found in the contig names and try again."%(item));
-			filter = vcf_columns[6];
-
-			if chrom_of_interest == "" or chrom_of_interest == chr:
-				if chr not in chromosome_pool:
-					chromosome_pool[chr] = [];
-				fields = vcf_columns[8].split(":");
-
-				if "GT" in fields:
-					gt_index = fields.index("GT");
-					geno_string = vcf_columns[9].split(":")[gt_index];
-					xgeno = list(geno_string);
-					if "." not in xgeno:
-						if "|" in xgeno: xgeno.remove("|");
-						if "/" in xgeno:
-							xgeno.remove("/");
-							unphased = True;
-
-						if len(set(xgeno)) > 1:
-							filters = filter.split(";");
-							if args.pass_only == 0 or "PASS" in filters:
-								chromosome_pool[chr].append(vcf_columns[0:9]+[geno_string,xgeno]);
-								if unphased == True:
-									unphased_count += 1;
-							else:
-								filter_count += 1;
-				else:
-					print_warning("Genotype, defined by GT not found in input VCF for variant %s."%(vcf_columns[2]));
+	tables, total_sites, filter_count, unphased_count, blacklist_count = het_tables;
+	del het_tables;
 
+	if args.blacklist != "":
+		fun_flush_print("          %d heterozygous sites removed by blacklist"%(blacklist_count));
 
-	pool_input = [];
-	for chrom in chromosome_pool.keys():
-		pool_input.append([chrom,chromosome_pool[chrom]]);
+	# split contigs into read mapping shards so that large chromosomes don't limit parallelization
+	if args.shard_size > 0:
+		shard_size = args.shard_size;
+	elif args.threads > 1:
+		shard_size = max([1000, int(math.ceil(float(total_sites) / (args.threads * 4)))]);
+	else:
+		shard_size = 0;
 
+	# tables stored in the cache directory are kept for later runs
 	global temp_files;
 	temp_files = [];
-	pool_output = parallelize(generate_mapping_table, pool_input);
-
-	# clear memory
-	del pool_input;
-	del chromosome_pool;
+	if args.cache_dir == "":
+		temp_files = [x[3] for x in tables];
 
 	mapping_files = [];
 
 	het_count = 0;
 	total_indels_excluded = 0;
-	for output in pool_output:
-		mapping_files.append([output[0],output[3],output[4]]);
-		het_count += output[1];
-		total_indels_excluded += output[2];
+	for table in tables:
+		shards = mapping_shards(table[4], shard_size);
+		for shard in shards:
+			mapping_files.append([table[0],table[3]]+shard+[len(shards)]);
+		het_count += table[1];
+		total_indels_excluded += table[2];
+
+	del tables;
 
 	fun_flush_print("          %d heterozygous sites being used for phasing (%d filtered, %d indels excluded, %d unphased)"%(het_count,filter_count,total_indels_excluded,unphased_count));
 	print
@@ -466,7 +824,7 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 	bam_list = args.bam.split(",");
 
 	# generate a list of bam names but don't allow any two to have the same ids
-	file_names = [os.path.basename(xbam).replace(".bam","") for xbam in bam_list];
+	file_names = [os.path.basename(xbam).replace(".bam","").replace(".cram","") for xbam in bam_list];
 
 	bam_names = [];
 	bam_counter = collections.OrderedDict()
@@ -501,126 +859,132 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 	elif len(paired_end_list) != len(bam_list):
 		fatal_error ("Number of paired_end values and input BAMs does not match. Supply either one paired_end to be used for all BAMs or one paired_end per input BAM.");
 
-	#now get bam reads that overlap het sites using SAMTOOLS
-	samtools_arg_list=[];
-	# remove dups if necessary, and only include properly paired read (ie in correct orientation)
-	for i in paired_end_list:
-		samtools_arg=""
-		if args.remove_dups == 1:
-			samtools_arg += "-F 0x400 "
-		if int(i) == 1:
-			samtools_arg += "-f 2"
-		samtools_arg_list.append(samtools_arg)
-
-	global dict_variant_reads;
-	dict_variant_reads = collections.OrderedDict()
-
-	global read_vars;
-	read_vars = collections.OrderedDict()
-
-	global bam_index;
-	bam_index = 0;
+	global var_store;
 
-	total_reads = 0;
+	# read names by chromosome, only kept when read IDs are output
+	global read_names;
+	read_names = {};
 
-	for samtools_arg, bam, mapq, isize in zip(samtools_arg_list, bam_list, mapq_list, isize_list):
+	bam_settings = [];
+	for paired_end, bam, mapq, isize in zip(paired_end_list, bam_list, mapq_list, isize_list):
 		fun_flush_print("     file: %s"%(bam));
 		fun_flush_print("          minimum mapq: %s"%(mapq));
+		bam_settings.append([bam, int(mapq), isize, int(paired_end)]);
 
-		# use the read variant mapping script to map reads to alleles
-		fun_flush_print("          mapping reads to variants...");
-		pool_input = [x + [samtools_arg,bam,mapq,isize] for x in mapping_files];
-		result_files = parallelize(call_mapping_script, pool_input);
-
-		# process the result
-
-		# A determine if we need to calculate alignment score cutoff
-		fun_flush_print("          processing mapped reads...");
-
-		global use_as_cutoff;
-		global as_cutoff;
+	# contigs that are missing from a BAM or have no mapped reads in its index are not fetched from it
+	bam_mapped_contigs = [read_variant_map.mapped_contigs(x, args.reference) for x in bam_list];
 
-		use_as_cutoff = False;
-
-		if args.as_q_cutoff > 0:
-			alignment_scores = map(int,[x for x in subprocess.check_output("set -euo pipefail && "+"cut -f 5 "+" ".join(result_files), shell=True, executable='/bin/bash').split("\n") if x != ""]);
-			if len(alignment_scores) == 0:
-				fun_flush_print("          no alignment score value found in reads, cannot use cutoff");
+	mapped_shards = [];
+	pool_input = [];
+	skipped_contigs = set([]);
+	for shard in mapping_files:
+		shard_bams = [];
+		for xbam in range(0, len(bam_list)):
+			if shard[0] in bam_mapped_contigs[xbam]:
+				shard_bams.append(bam_settings[xbam]);
 			else:
-				as_cutoff = numpy.percentile(alignment_scores,args.as_q_cutoff*100);
-				use_as_cutoff = True;
-				fun_flush_print("          using alignment score cutoff of %d"%(as_cutoff));
+				shard_bams.append(None);
+
+		if shard_bams.count(None) == len(shard_bams):
+			skipped_contigs.add(shard[0]);
+		elif len(shard[7]) > 0:
+			mapped_shards.append(shard);
+			pool_input.append(shard + [shard_bams]);
+	mapping_files = mapped_shards;
+
+	if len(skipped_contigs) > 0:
+		fun_flush_print("     skipping %d contigs without mapped reads"%(len(skipped_contigs)));
+
+	# use the read variant mapping script to map reads to alleles
+	# each shard is mapped in a single pass over all of the BAMs, with hits tagged by the index of the BAM
+	fun_flush_print("     mapping reads to variants...");
+	pool_output = parallelize(call_mapping_script, pool_input);
+	result_files = [x[0] for x in pool_output];
+	# alignment files are kept open between shards, close any opened in this process so they are not shared with forked workers
+	read_variant_map.close_alignment_files();
+
+	# output the read mapping metrics of each shard
+	write_mapping_metrics(out_prefix + ".mapping_metrics.txt", mapping_files, [x[2] for x in pool_output], bam_names);
+
+	# stitch the shards of each chromosome back together in order
+	chrom_results = collections.OrderedDict();
+	for shard, result_file in zip(mapping_files, result_files):
+		if shard[0] not in chrom_results: chrom_results[shard[0]] = [shard[0], shard[1], []];
+		chrom_results[shard[0]][2].append(result_file);
+
+	# process the result
+
+	# A determine if we need to calculate alignment score cutoff, for each BAM
+	fun_flush_print("     processing mapped reads...");
+
+	global as_cutoffs;
+
+	as_cutoffs = [None] * len(bam_list);
+
+	if args.as_q_cutoff > 0:
+		# merge the alignment score histograms from each shard, the cutoff is exact without re-reading the results
+		for xbam in range(0, len(bam_list)):
+			as_histogram = {};
+			for output in pool_output:
+				for alignment_score, count in output[1][xbam].items():
+					as_histogram[alignment_score] = as_histogram.get(alignment_score, 0) + count;
+
+			if len(as_histogram) == 0:
+				fun_flush_print("          %s: no alignment score value found in reads, cannot use cutoff"%(bam_names[xbam]));
+			else:
+				as_cutoffs[xbam] = histogram_percentile(as_histogram,args.as_q_cutoff*100);
+				fun_flush_print("          %s: using alignment score cutoff of %d"%(bam_names[xbam],as_cutoffs[xbam]));
 
-		# B now process variant read overlaps
-		pool_output = parallelize(process_mapping_result, result_files);
+	del pool_output;
 
-		for output in pool_output:
-			for variant in output[0]:
-				if variant not in dict_variant_reads:
-					dict_variant_reads[variant] = output[0][variant];
-				else:
-					dict_variant_reads[variant]['reads'][0] += output[0][variant]['reads'][0];
-					dict_variant_reads[variant]['reads'][1] += output[0][variant]['reads'][1];
-					for xallele in [0,1]:
-						for xbam in output[0][variant]['haplo_reads'][xallele].keys():
-							if xbam in dict_variant_reads[variant]['haplo_reads'][xallele]:
-								dict_variant_reads[variant]['haplo_reads'][xallele][xbam] += output[0][variant]['haplo_reads'][xallele][xbam];
-							else:
-								dict_variant_reads[variant]['haplo_reads'][xallele][xbam] = output[0][variant]['haplo_reads'][xallele][xbam]
-					dict_variant_reads[variant]['other_reads'] += output[0][variant]['other_reads'];
+	# B now process variant read overlaps, chromosomes are independent so the results don't need to be merged
+	pool_output = parallelize(process_mapping_result, chrom_results.values());
 
-		for output in pool_output:
-			if output[3] not in read_vars: read_vars[output[3]] = collections.OrderedDict()
+	bam_reads = [0] * len(bam_list);
+	downsampled_count = 0;
+	chrom_columns = [];
+	for output in pool_output:
+		downsampled_count += output[4];
+		chrom_columns.append([output[2], output[0]]);
+		if output[3] != None:
+			read_names[output[2]] = output[3];
+		for xbam in range(0, len(bam_list)):
+			bam_reads[xbam] += output[1][xbam];
 
-		for output in pool_output:
-			for read in output[1]:
-				if variant not in read_vars[output[3]]:
-					read_vars[output[3]][read] = output[1][read];
-				else:
-					read_vars[output[3]][read]  += output[1][read];
+	del pool_output;
 
-		bam_reads = 0;
-		for output in pool_output:
-			total_reads += output[2];
-			bam_reads += output[2];
+	var_store = build_variant_store(chrom_columns);
+	del chrom_columns;
 
-		del pool_output;
+	for xbam in range(0, len(bam_list)):
+		fun_flush_print("     file: %s retrieved %d reads"%(bam_list[xbam],bam_reads[xbam]));
+	total_reads = sum(bam_reads);
 
-		fun_flush_print("          retrieved %d reads"%(bam_reads));
-		bam_index += 1;
+	if args.max_variant_depth > 0:
+		fun_flush_print("     %d variants downsampled to a maximum depth of %d reads"%(downsampled_count,args.max_variant_depth));
 
-		# delete temp mapping files
-		for xfile in result_files:
-			os.remove(xfile);
+	# delete temp mapping files
+	for xfile in result_files:
+		os.remove(xfile);
+		os.remove(xfile+".reads");
 
 	#cleanup temp files
-	if args.process_slow == 0 or \
-			(args.process_slow == 1 and last_chr==True):
-		os.remove(vcf_out.name);
-		os.remove(mapper_out.name);
-		os.remove(bed_out.name);
-
 	for xfile in temp_files:
 		os.remove(xfile);
 
 	fun_flush_print("#3. Identifying connected variants...");
 	fun_flush_print("     calculating sequencing noise level...");
 
-	# calculate noise level
-	base_match_count = 0;
-	base_mismatch_count = 0;
+	# calculate noise level, from counts taken before downsampling
+	matches = var_store.noise_counts[:, 0];
+	mis_matches = var_store.noise_counts[:, 1];
 
-	for variant in dict_variant_reads:
-		mis_matches = 0;
-
-		mis_matches = len(dict_variant_reads[variant]['other_reads']);
-		matches = sum([len(x) for x in dict_variant_reads[variant]['reads']]);
-
-		# require other bases to be < 5% of total coverage for this variant
-		# protects against genotyping errors
-		if matches > 0 and (float(mis_matches) / float(mis_matches+matches)) < 0.05:
-			base_match_count += matches;
-			base_mismatch_count += mis_matches;
+	# require other bases to be < 5% of total coverage for this variant
+	# protects against genotyping errors
+	use_variants = matches > 0;
+	use_variants[use_variants] = (mis_matches[use_variants].astype(numpy.float64) / (mis_matches[use_variants] + matches[use_variants])) < 0.05;
+	base_match_count = int(matches[use_variants].sum());
+	base_mismatch_count = int(mis_matches[use_variants].sum());
 
 	if base_match_count == 0:
 		fatal_error("No reads could be matched to variants. Please double check your settings and input files. Common reasons for this occurring include: 1) MAPQ or BASEQ set too conservatively 2) BAM and VCF have different chromosome names (IE 'chr1' vs '1').");
@@ -630,100 +994,49 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 	noise_e = (float(base_mismatch_count) / (float(base_match_count+base_mismatch_count)*2));
 	fun_flush_print("     sequencing noise level estimated at %f"%(noise_e));
 
-	# premake read sets for faster comparison
-	fun_flush_print("     creating read sets...");
-	for var_id in dict_variant_reads:
-		dict_variant_reads[var_id]['read_set'] = [];
-		for allele_reads in dict_variant_reads[var_id]['reads']:
-			dict_variant_reads[var_id]['read_set'].append(set(allele_reads));
-		dict_variant_reads[var_id]['other_read_set'] = set(dict_variant_reads[var_id]['other_reads']);
-
 	# now create the quick lookup dictionary
 	# this is used for haplotype construction
 	# dictionary tells you what variants are connected
 	fun_flush_print("     generating read connectivity map...");
-	global dict_variant_overlap;
-	dict_variant_overlap = collections.OrderedDict()
-
-	pool_input = read_vars.keys();
-	pool_output = parallelize(generate_connectivity_map, pool_input);
-
-	for output in pool_output:
-		dict_variant_overlap.update(output);
-
-	# clear memory
-	del pool_output;
-	del read_vars;
-
-	# make sets of overlaps
-	for chr in dict_variant_overlap:
-		for variant in dict_variant_overlap[chr]:
-			dict_variant_overlap[chr][variant] = set(dict_variant_overlap[chr][variant]);
+	pool_output = parallelize(generate_connectivity_map, var_store.contigs);
 
 	## now run the test to determine if the number of reads with conflicting connections is
 	## higher than noise for a given variant pair.
 	## if so these two variants will be disconnected, so that they won't be used for haplotype construction
-	tested_connections = set([]);
-	pool_input = [];
 	fun_flush_print("     testing variant connections versus noise...");
-	for chr in dict_variant_overlap:
-		for variant_a in dict_variant_overlap[chr]:
-			overlapping_variants = dict_variant_overlap[chr][variant_a];
-			for variant_b in overlapping_variants:
-				key1 = variant_a+"|"+variant_b;
-				key2 = variant_b+"|"+variant_a;
-				if key1 not in tested_connections and key2 not in tested_connections:
-					pool_input.append([chr,variant_a,variant_b]);
-					tested_connections.add(key1);
-
-	pool_output = parallelize(test_variant_connection, pool_input);
 
 	#out_stream = open(args.o+".variant_connections.txt","w");
 	out_stream = open(out_prefix + ".variant_connections.txt", "w");
 	out_stream.write("variant_a\tvariant_b\tsupporting_connections\ttotal_connections\tconflicting_configuration_p\tphase_concordant\n");
 
-	dict_allele_connections = collections.OrderedDict()
+	# the pairs which passed are kept with their chosen configuration, these are what the haplotypes are built from
+	passed_pairs = [[numpy.zeros(0, dtype=numpy.int64)], [numpy.zeros(0, dtype=numpy.int64)], [numpy.zeros(0, dtype=numpy.int8)]];
 
 	# remove all those connections which failed
 	c_dropped = 0;
-	for connection in pool_output:
-		chr,variant_a,variant_b,conflicting_config_p,c_supporting,c_total,phase_concordant,chosen_config = connection;
+	for chrom, output in zip(var_store.contigs, pool_output):
+		pair_a, pair_b, counts = output;
+		c_supporting, c_total, conflicting_config_p, tested, phase_concordant, chosen_config = test_variant_connections(pair_a, pair_b, counts);
+
+		pair_ids = [[var_store.ids[x] for x in pair_a.tolist()], [var_store.ids[x] for x in pair_b.tolist()]];
+		p_fields = [str(p) if test else str(int(p)) for p, test in itertools.izip(conflicting_config_p, tested.tolist())];
+		concordant_fields = ["." if x < 0 else x for x in phase_concordant.tolist()];
+		for out_fields in itertools.izip(pair_ids[0], pair_ids[1], c_supporting.tolist(), c_total.tolist(), p_fields, concordant_fields):
+			out_stream.write("\t".join(map(str,out_fields))+"\n");
 
 		# if the number of conflicting reads is more than would be expected from noise, then disconnect these two variants
 		# they will not be used for haplotype construction
-		out_stream.write("\t".join(map(str,[variant_a,variant_b,c_supporting,c_total,conflicting_config_p,phase_concordant]))+"\n");
-		if conflicting_config_p < args.cc_threshold:
-			#print("%s	%s"%(variant_a,variant_b));
-			dict_variant_overlap[chr][variant_a].remove(variant_b);
-			dict_variant_overlap[chr][variant_b].remove(variant_a);
-
-			# if these variants have no other connections remove them from overlap dictionary
-			if len(dict_variant_overlap[chr][variant_a]) == 0:
-				del dict_variant_overlap[chr][variant_a];
-			if len(dict_variant_overlap[chr][variant_b]) == 0:
-				del dict_variant_overlap[chr][variant_b];
-
-			c_dropped += 1;
-		else:
-			# didn't drop record the specific allele connections
-			if variant_a+":0" not in dict_allele_connections: dict_allele_connections[variant_a+":0"] = set([]);
-			if variant_a+":1" not in dict_allele_connections: dict_allele_connections[variant_a+":1"] = set([]);
-			if variant_b+":0" not in dict_allele_connections: dict_allele_connections[variant_b+":0"] = set([]);
-			if variant_b+":1" not in dict_allele_connections: dict_allele_connections[variant_b+":1"] = set([]);
-
-			if chosen_config == 0:
-				# 0 - 0 / 1 - 1
-				dict_allele_connections[variant_a+":0"].add(variant_b+":0");
-				dict_allele_connections[variant_b+":0"].add(variant_a+":0");
-				dict_allele_connections[variant_a+":1"].add(variant_b+":1");
-				dict_allele_connections[variant_b+":1"].add(variant_a+":1");
-			elif chosen_config == 1:
-				# 0 - 1 / 1 - 0
-				dict_allele_connections[variant_a+":0"].add(variant_b+":1");
-				dict_allele_connections[variant_b+":0"].add(variant_a+":1");
-				dict_allele_connections[variant_a+":1"].add(variant_b+":0");
-				dict_allele_connections[variant_b+":1"].add(variant_a+":0");
+		passed = conflicting_config_p >= args.cc_threshold;
+		c_dropped += len(passed) - int(passed.sum());
+
+		passed_pairs[0].append(pair_a[passed]);
+		passed_pairs[1].append(pair_b[passed]);
+		passed_pairs[2].append(chosen_config[passed]);
+
+	link_a, link_b, link_config = [numpy.concatenate(x) for x in passed_pairs];
 
+	# clear memory
+	del pool_output;
 
 	out_stream.close();
 
@@ -734,45 +1047,56 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 
 	#stream_out = open(args.o + ".allelic_counts.txt", "w");
 	stream_out = open(out_prefix + ".allelic_counts.txt", "w");
-	stream_out.write("contig	position	variantID	refAllele	altAllele	refCount	altCount	totalCount\n");
+	if args.max_variant_depth > 0:
+		stream_out.write("contig	position	variantID	refAllele	altAllele	refCount	altCount	totalCount	downsampled\n");
+	else:
+		stream_out.write("contig	position	variantID	refAllele	altAllele	refCount	altCount	totalCount\n");
 	covered_count = 0;
 
-	for variant in dict_variant_reads:
-		snp_dict = dict_variant_reads[variant];
-
-		ref_reads = len(set(snp_dict['reads'][0]));
-		alt_reads = len(set(snp_dict['reads'][1]));
+	# downsampled variants keep the exact counts
+	read_counts = var_store.read_counts.tolist();
+	positions = var_store.pos.tolist();
+	downsampled = var_store.downsampled.tolist();
+	for var_index in range(0, len(var_store)):
+		ref_reads, alt_reads = read_counts[var_index];
 		if ref_reads+alt_reads > 0:
 			covered_count += 1;
-			stream_out.write("\t".join([snp_dict['chr'],str(snp_dict['pos']),variant,snp_dict['alleles'][0],snp_dict['alleles'][1],str(ref_reads),str(alt_reads),str(ref_reads+alt_reads)+"\n"]));
+			fields_out = [var_store.chr(var_index),str(positions[var_index]),var_store.ids[var_index],var_store.allele(var_index,0),var_store.allele(var_index,1),str(ref_reads),str(alt_reads),str(ref_reads+alt_reads)];
+			if args.max_variant_depth > 0:
+				fields_out.append(str(int(downsampled[var_index])));
+			stream_out.write("\t".join(fields_out)+"\n");
 	stream_out.close();
 
 	fun_flush_print("     %d variants covered by at least 1 read"%(covered_count));
 
 	# record the total number of hets
-	total_het_variants = len(dict_variant_reads.keys());
+	total_het_variants = len(var_store);
 
-	remove_keys = [];
 	if args.unphased_vars == 0:
-		# clear all SNPs with no connections to others from the dictionary to free up memory
+		# clear all SNPs with no connections to others from the store to free up memory
 		# if we don;t want to output unphased snps
-
-		for variant in dict_variant_reads:
-			chr = dict_variant_reads[variant]['chr'];
-			if chr not in dict_variant_overlap:
-				remove_keys.append(variant);
-			elif variant not in dict_variant_overlap[chr]:
-				remove_keys.append(variant);
+		keep_variants = numpy.zeros(len(var_store), dtype=bool);
+		keep_variants[link_a] = True;
+		keep_variants[link_b] = True;
 	else:
 		# otherwise just remove variants with 0 coverage
-		for variant in dict_variant_reads:
-			if len(dict_variant_reads[variant]['reads'][0]) + len(dict_variant_reads[variant]['reads'][1]) == 0:
-				remove_keys.append(variant);
+		keep_variants = (var_store.hit_counts[:, 0] + var_store.hit_counts[:, 1]) > 0;
+
+	removed_count = len(var_store) - int(keep_variants.sum());
+	var_store = var_store.subset(keep_variants);
 
-	for key in remove_keys:
-		del dict_variant_reads[key];
+	# the passing pairs are renumbered to the remaining variants
+	kept_index = numpy.cumsum(keep_variants) - 1;
+	kept_links = keep_variants[link_a] & keep_variants[link_b];
+	link_a = kept_index[link_a[kept_links]];
+	link_b = kept_index[link_b[kept_links]];
+	link_config = link_config[kept_links];
 
-	print_debug("     removed %d variants from memory in cleanup"%(len(remove_keys)));
+	print_debug("     removed %d variants from memory in cleanup"%(removed_count));
+
+	global variant_graph;
+	global allele_graph;
+	variant_graph, allele_graph = build_connection_graphs(len(var_store), link_a, link_b, link_config);
 
 	# using only the overlapping SNP dictionary build haplotype blocks
 	fun_flush_print("#4. Identifying haplotype blocks...");
@@ -780,29 +1104,14 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 	block_haplotypes = [];
 	phased_vars = 0;
 
-	pool_output = parallelize(build_haplotypes, dict_variant_overlap.values());
-
-	for chr_haplotypes in pool_output:
-		for haplotype_block in chr_haplotypes:
-			block_haplotypes.append(haplotype_block);
-			phased_vars += len(haplotype_block);
+	for haplotype_block in build_haplotypes(variant_graph):
+		block_haplotypes.append(haplotype_block);
+		phased_vars += len(haplotype_block);
 
 	# now for each of the blocks identify the phasing with the most supporting reads
+	# each block is phased with the connections between its variants taken from the graphs
 	fun_flush_print("#5. Phasing blocks...");
-	pool_input = [];
-
-	for block in block_haplotypes:
-		# retrieve all allele connections for block;
-		variant_connections = collections.OrderedDict()
-		allele_connections = collections.OrderedDict()
-
-		for variant in block:
-			chr = variant.split(args.id_separator)[0];
-			if variant in dict_variant_overlap[chr]: variant_connections[variant] = dict_variant_overlap[chr][variant];
-			if variant+":0" in dict_allele_connections: allele_connections[variant+":0"] = dict_allele_connections[variant+":0"]
-			if variant+":1" in dict_allele_connections: allele_connections[variant+":1"] = dict_allele_connections[variant+":1"]
-
-		pool_input.append([sort_var_ids(block),variant_connections,allele_connections]);
+	pool_input = block_haplotypes;
 
 	pool_output = parallelize(phase_v3, pool_input);
 	final_haplotypes = [];
@@ -861,45 +1170,30 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 	# value of initial "block index" is based on value of "pi block value" (which is global variable)
 	block_index = pi_block_value
 
-	for block in final_haplotypes:
-		#get all unique variants
+	for block_variants, haplotype_a in final_haplotypes:
+		#get all unique variants, ids are only needed from here on for output
 		block_index += 1;
-		variants = [x.split(":")[0] for x in block];
-		variants = sort_var_ids(variants);
+		var_indexes = block_variants.tolist();
+		variants = [var_store.ids[x] for x in var_indexes];
 
 		all_variants += variants;
 
-		haplotype_a = "".join([x.split(":")[1] for x in block]);
 		haplotype_b = "".join([str(int(not int(x))) for x in haplotype_a]);
 
 		# determine number of supporting edges vs total edges for this haplotype
-		supporting_connections = 0;
-		total_connections = 0;
-
-		for allele in block:
-			variant = allele.split(":")[0];
-			for other_allele in block:
-				if allele != other_allele:
-					other_variant = other_allele.split(":")[0];
-					# check if the configuration supports the phasing
-					if other_allele in dict_allele_connections[allele]:
-						supporting_connections += 1;
-
-					if other_variant+":0" in dict_allele_connections[allele]:
-						total_connections += 1;
-					if other_variant+":1" in dict_allele_connections[allele]:
-						total_connections += 1;
-
-		supporting_connections = supporting_connections / 2;
-		total_connections = total_connections / 2;
+		# the graph holds each connection from both of its alleles
+		hap_nodes = (2 * block_variants) + numpy.array([int(x) for x in haplotype_a], dtype=numpy.int64);
+		block_nodes = numpy.column_stack([2 * block_variants, (2 * block_variants) + 1]).ravel();
+		supporting_connections = allele_graph[hap_nodes][:, hap_nodes].nnz / 2;
+		total_connections = allele_graph[hap_nodes][:, block_nodes].nnz / 2;
 
 		if args.unique_ids == 0:
-			rsids = [dict_variant_reads[x]['rsid'] for x in variants];
+			rsids = [var_store.rsids[x] for x in var_indexes];
 		else:
 			rsids = variants;
 
-		chrs = [dict_variant_reads[x]['chr'] for x in variants];
-		positions = map(int, [dict_variant_reads[x]['pos'] for x in variants]);
+		chrs = [var_store.chr(x) for x in var_indexes];
+		positions = [int(var_store.pos[x]) for x in var_indexes];
 
 		hap_p = 0;
 		haplotype_pvalue_lookup[list_to_string(variants)] = hap_p;
@@ -909,6 +1203,7 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 			haplotype_lookup[id] = [variants, haplotype_a[var_index]+"|"+haplotype_b[var_index],block_index];
 
 		alleles = [[],[]];
+		ref_alleles = [[],[]];
 		phases = [[],[]];
 		set_reads = [[],[]];
 		hap_counts = [0,0];
@@ -917,14 +1212,13 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 			hap_x = [haplotype_a, haplotype_b][hap_index];
 
 			for var_index in range(0, len(variants)):
-				id = variants[var_index];
-				allele = dict_variant_reads[id]['alleles'][int(hap_x[var_index])];
-				alleles[hap_index].append(allele);
-				phases[hap_index].append(get_allele_phase(allele,dict_variant_reads[id]));
-
-				allele_index = dict_variant_reads[id]['alleles'].index(allele);
+				id = var_indexes[var_index];
+				allele_index = int(hap_x[var_index]);
+				alleles[hap_index].append(var_store.allele(id, allele_index));
+				ref_alleles[hap_index].append(var_store.alleles[id][allele_index] == 0);
+				phases[hap_index].append(get_allele_phase(id, allele_index));
 
-				set_reads[hap_index] += dict_variant_reads[id]['reads'][allele_index];
+				set_reads[hap_index] += var_store.reads(id, allele_index);
 
 			set_reads[hap_index] = list(set(set_reads[hap_index]));
 			hap_counts[hap_index] = len(set_reads[hap_index]);
@@ -952,8 +1246,8 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 
 		# get the MAF for each variant in haplotype
 		haplotype_mafs = [];
-		for variant in variants:
-			haplotype_mafs.append(dict_variant_reads[variant]['maf']);
+		for var_index in var_indexes:
+			haplotype_mafs.append(var_store.maf_value(var_index));
 
 		if len(nan_strip) > 0:
 			# if setting is on determine genome wide phasing
@@ -1027,12 +1321,11 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 		haplotype_gw_stat_lookup[list_to_string(variants)] = cor_phase_stat;
 		haplotype_max_maf_lookup[list_to_string(variants)] = max(haplotype_mafs);
 
-		# update the variants with their corrected phases
+		# update the variants with their corrected phases, phases that are not known are stored as -1
 		for var_index in range(0,len(variants)):
-			variant = variants[var_index];
-			allele_index = dict_variant_reads[variant]['alleles'].index(alleles[0][var_index])
-			dict_variant_reads[variant]['gw_phase'][allele_index] = corrected_phases[0][var_index];
-			dict_variant_reads[variant]['gw_phase'][1-allele_index] = corrected_phases[1][var_index];
+			allele_index = int(haplotype_a[var_index]);
+			var_store.gw_phase[var_indexes[var_index]][allele_index] = corrected_phases[0][var_index] if corrected_phases[0][var_index] >= 0 else -1;
+			var_store.gw_phase[var_indexes[var_index]][1-allele_index] = corrected_phases[1][var_index] if corrected_phases[1][var_index] >= 0 else -1;
 
 		corrected_phase_string = ["",""]
 		corrected_phase_string[0] = "".join([str(x).replace("nan", "-") for x in corrected_phases[0]]);
@@ -1062,23 +1355,18 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 
 					for var_index in range(0, len(variants)):
 						id = variants[var_index];
-						chrom = dict_variant_reads[id]['chr'];
-						pos = int(dict_variant_reads[id]['pos']);
-						used_var_pos.append(pos);
+						used_var_pos.append(positions[var_index]);
 						# check to see if variant is blacklisted
-						if chrom+"_"+str(pos) not in set_haplo_blacklist:
+						if var_store.haplo_blacklisted[var_indexes[var_index]] == False:
 
-							allele = dict_variant_reads[id]['alleles'][int(hap_x[var_index])];
-							allele_index = dict_variant_reads[id]['alleles'].index(allele);
+							allele_index = int(hap_x[var_index]);
 
 							if id not in used_vars: used_vars.append(id);
-							used_alleles[hap_index].append(allele);
+							used_alleles[hap_index].append(alleles[hap_index][var_index]);
 
-							if bam_i in dict_variant_reads[id]['haplo_reads'][allele_index]:
-								var_reads[hap_index].append(dict_variant_reads[id]['haplo_reads'][allele_index][bam_i]);
-								set_hap_expr_reads[hap_index] += dict_variant_reads[id]['haplo_reads'][allele_index][bam_i];
-							else:
-								var_reads[hap_index].append([]);
+							allele_bam_reads = var_store.reads(var_indexes[var_index], allele_index, bam_i);
+							var_reads[hap_index].append(allele_bam_reads);
+							set_hap_expr_reads[hap_index] += allele_bam_reads;
 						else:
 							blacklisted_vars.add(id);
 
@@ -1117,7 +1405,7 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 				if total_cov > 0:
 					fields_out = [chrs[0],min(used_var_pos),max(used_var_pos),list_to_string(used_vars),len(used_vars),list_to_string(blacklisted_vars),len(blacklisted_vars),list_to_string(used_alleles[0]),list_to_string(used_alleles[1]),hap_a_count,hap_b_count,total_cov,out_block_gw_phase,cor_phase_stat];
 					if args.output_read_ids == 1:
-						fields_out += [list_to_string(hap_a_reads),list_to_string(hap_b_reads)];
+						fields_out += [list_to_string(read_id_names(chrs[0],hap_a_reads)),list_to_string(read_id_names(chrs[0],hap_b_reads))];
 					fields_out += [str(max(haplotype_mafs)),bam_name];
 					fields_out += [hap_var_reads[0],hap_var_reads[1]];
 
@@ -1156,19 +1444,17 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 			stream_out_network.close()
 
 		## OUTPUT allele configuration
-		for variant_a, allele_a in zip(variants, alleles[0]):
-			for variant_b, allele_b in zip(variants, alleles[1]):
+		for variant_a, index_a, ref_a in zip(variants, var_indexes, ref_alleles[0]):
+			for variant_b, index_b, ref_b in zip(variants, var_indexes, ref_alleles[1]):
 				if variant_a != variant_b:
-					a_config = "";
-					if (dict_variant_reads[variant_a]['ref'] == allele_a and dict_variant_reads[variant_b]['ref'] == allele_b) or (dict_variant_reads[variant_a]['ref'] != allele_a and dict_variant_reads[variant_b]['ref'] != allele_b):
+					if ref_a == ref_b:
 						# ref and ref are in trans
 						# this is a compound het
 						a_config = "trans";
-					elif (dict_variant_reads[variant_a]['ref'] == allele_a and dict_variant_reads[variant_b]['ref'] != allele_b) or (dict_variant_reads[variant_a]['ref'] != allele_a and dict_variant_reads[variant_b]['ref'] == allele_b):
+					else:
 						# ref and ref are in cis
 						a_config = "cis";
-					if a_config != "":
-						stream_out_allele_configs.write("\t".join([variant_a,dict_variant_reads[variant_a]['rsid'],variant_b,dict_variant_reads[variant_b]['rsid'],a_config])+"\n");
+					stream_out_allele_configs.write("\t".join([variant_a,var_store.rsids[index_a],variant_b,var_store.rsids[index_b],a_config])+"\n");
 
 	# update pi_block_value after the loop is over
 	if args.process_slow == 1:
@@ -1177,65 +1463,58 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 
 	#output read counts for unphased variants
 	if args.unphased_vars == 1:
-		singletons = set(dict_variant_reads.keys()) - set(all_variants);
+		singletons = set(var_store.ids) - set(all_variants);
 
 		for variant in singletons:
-			dict_var = dict_variant_reads[variant];
-			chrom = dict_var['chr'];
-			pos = int(dict_var['pos']);
+			var_index = var_store.index[variant];
+			chrom = var_store.chr(var_index);
+			pos = int(var_store.pos[var_index]);
 
 			# check to see if variant is blacklisted
-			if chrom+"_"+str(pos) not in set_haplo_blacklist:
+			if var_store.haplo_blacklisted[var_index] == False:
 
 				for bam_i in range(0,len(bam_list)):
 					if bam_i not in haplo_count_bam_exclude:
 						bam_name = bam_names[bam_i];
-						if bam_i in dict_var['haplo_reads'][0]:
-							hap_a_count = len(set(dict_var['haplo_reads'][0][bam_i]));
-							hap_a_reads = set(dict_var['haplo_reads'][0][bam_i]);
-						else:
-							hap_a_count = 0;
-							hap_a_reads = [];
-
-						if bam_i in dict_var['haplo_reads'][1]:
-							hap_b_count = len(set(dict_var['haplo_reads'][1][bam_i]));
-							hap_b_reads = set(dict_var['haplo_reads'][1][bam_i]);
-						else:
-							hap_b_count = 0;
-							hap_b_reads = [];
+						hap_a_reads = set(var_store.reads(var_index, 0, bam_i));
+						hap_a_count = len(hap_a_reads);
+						hap_b_reads = set(var_store.reads(var_index, 1, bam_i));
+						hap_b_count = len(hap_b_reads);
 
 						total_cov = int(hap_a_count)+int(hap_b_count);
 						if total_cov > 0:
-							if "-" not in dict_var['phase']:
-								phase_string = str(dict_var['phase'].index(dict_var['alleles'][0]))+"|"+str(dict_var['phase'].index(dict_var['alleles'][1]));
+							if var_store.phase[var_index][0] >= 0:
+								phase_string = str(var_store.phase[var_index][0])+"|"+str(var_store.phase[var_index][1]);
 							else:
 								phase_string = "0/1";
-							fields_out = [dict_var['chr'],str(dict_var['pos']),str(dict_var['pos']),variant,str(1),"",str(0),dict_var['alleles'][0],dict_var['alleles'][1],str(hap_a_count),str(hap_b_count),str(total_cov),phase_string,"1"];
+							fields_out = [chrom,str(pos),str(pos),variant,str(1),"",str(0),var_store.allele(var_index,0),var_store.allele(var_index,1),str(hap_a_count),str(hap_b_count),str(total_cov),phase_string,"1"];
 
 							if args.output_read_ids == 1:
-								fields_out += [list_to_string(hap_a_reads),list_to_string(hap_b_reads)];
+								fields_out += [list_to_string(read_id_names(chrom,hap_a_reads)),list_to_string(read_id_names(chrom,hap_b_reads))];
 
-							fields_out += [str(dict_var['maf']),bam_name];
+							fields_out += [str(var_store.maf_value(var_index)),bam_name];
 							fields_out += ["",""];
 							stream_out_ase.write("\t".join(fields_out)+"\n");
 
 		#output haplotypes for unphased variants (if enabled)
 		for variant in singletons:
-			dict_var = dict_variant_reads[variant];
-			total_cov = len(dict_var['read_set'][0])+len(dict_var['read_set'][1]);
+			var_index = var_store.index[variant];
+			set_counts = var_store.set_counts[var_index].tolist();
+			pos = int(var_store.pos[var_index]);
+			total_cov = set_counts[0]+set_counts[1];
 
 			# make sure it is actually phased
-			if "-" not in dict_var['phase']:
-				phase_string = str(dict_var['phase'].index(dict_var['alleles'][0]))+"|"+str(dict_var['phase'].index(dict_var['alleles'][1]));
+			if var_store.phase[var_index][0] >= 0:
+				phase_string = str(var_store.phase[var_index][0])+"|"+str(var_store.phase[var_index][1]);
 			else:
 				phase_string = "-|-";
 
 			if args.unique_ids == 0:
-				out_name = dict_var['rsid'];
+				out_name = var_store.rsids[var_index];
 			else:
 				out_name = variant;
 
-			stream_out.write(dict_var['chr']+"\t"+str(dict_var['pos']-1)+"\t"+str(dict_var['pos'])+"\t"+str(1)+"\t"+str(1)+"\t"+out_name+"\t"+dict_var['alleles'][0]+"|"+dict_var['alleles'][1]+"\t"+str(len(dict_var['read_set'][0]))+"\t"+str(len(dict_var['read_set'][1]))+"\t"+str(total_cov)+"\t"+str(0)+"\t"+str(0)+"\t"+phase_string+"\t"+str(float('nan'))+"\t"+phase_string+"\t"+str(float('nan'))+"\n");
+			stream_out.write(var_store.chr(var_index)+"\t"+str(pos-1)+"\t"+str(pos)+"\t"+str(1)+"\t"+str(1)+"\t"+out_name+"\t"+var_store.allele(var_index,0)+"|"+var_store.allele(var_index,1)+"\t"+str(set_counts[0])+"\t"+str(set_counts[1])+"\t"+str(total_cov)+"\t"+str(0)+"\t"+str(0)+"\t"+phase_string+"\t"+str(float('nan'))+"\t"+phase_string+"\t"+str(float('nan'))+"\n");
 
 	stream_out.close();
 	stream_out_ase.close();
@@ -1262,205 +1541,478 @@ def process_vcf(stream_vcf, chromosome, contig_ban, set_haplo_blacklist,
 		  format(chromosome, time.strftime("%H:%M:%S", time.gmtime(time.time() - start_time))))
 
 def generate_connectivity_map(chrom):
-	global read_vars;
-	global dict_variant_reads;
-
-	dict_variant_overlap = collections.OrderedDict();
-
-	for read_id in read_vars[chrom].keys():
-		overlapped_variants = read_vars[chrom][read_id];
-
-		for variant in overlapped_variants:
-			var_chr = dict_variant_reads[variant]['chr'];
-			for other_variant in overlapped_variants:
-				other_var_chr = dict_variant_reads[other_variant]['chr'];
-				# Restrict to being on the same chromosome, speeds up and allows parallelization
-				# might not be desired for some very specific cases (ie trans-splicing)
-				if var_chr == other_var_chr and other_variant != variant:
-					if var_chr not in dict_variant_overlap: dict_variant_overlap[var_chr] = collections.OrderedDict()
-					if variant not in dict_variant_overlap[var_chr]: dict_variant_overlap[var_chr][variant] = [];
-					dict_variant_overlap[var_chr][variant].append(other_variant);
-
-	return(dict_variant_overlap);
+	global var_store;
+
+	# connections are found with a sparse reads x alleles incidence matrix, with a column for each slot of each variant of the chromosome
+	# AT.A counts the reads shared by every pair of slots, which gives the evidence for every connected pair in one product
+	# Restrict to being on the same chromosome, speeds up and allows parallelization
+	# might not be desired for some very specific cases (ie trans-splicing)
+	first_variant, last_variant = var_store.chrom_range(chrom);
+	variant_count = last_variant - first_variant;
+	set_counts = var_store.set_counts[first_variant:last_variant].ravel();
+	entry_reads = var_store.set_reads[var_store.set_offsets[first_variant * 3]:var_store.set_offsets[last_variant * 3]].astype(numpy.int64);
+	entry_columns = numpy.repeat(numpy.arange(variant_count * 3, dtype=numpy.int64), set_counts);
+	if len(entry_reads) == 0:
+		return([numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros((0, 9), dtype=numpy.int64)]);
+
+	if args.long_read == 1 and args.long_read_window > 0:
+		pair_keys, pair_slots, pair_reads = long_read_window_pairs(entry_reads, entry_columns, first_variant, variant_count);
+	else:
+		incidence = scipy.sparse.csr_matrix((numpy.ones(len(entry_reads), dtype=numpy.int32), (entry_reads, entry_columns)), shape=(int(entry_reads.max()) + 1, variant_count * 3));
+		shared = (incidence.T * incidence).tocoo();
+		del incidence;
+
+		# each pair once, as the lower variant index first
+		upper = (shared.row // 3) < (shared.col // 3);
+		pair_keys = ((shared.row[upper] // 3).astype(numpy.int64) * variant_count) + (shared.col[upper] // 3);
+		pair_slots = ((shared.row[upper] % 3) * 3) + (shared.col[upper] % 3);
+		pair_reads = shared.data[upper];
+		del shared;
+
+	# read counts for each pair as [a allele * 3 + b allele], with alleles 0, 1 and 2 = other
+	pair_keys, pair_index = numpy.unique(pair_keys, return_inverse=True);
+	counts = numpy.bincount((pair_index * 9) + pair_slots, weights=pair_reads, minlength=len(pair_keys) * 9).astype(numpy.int64).reshape(len(pair_keys), 9);
+
+	# connect the variants of each pair that has reads with ref or alt alleles at both
+	connected = (counts[:, 0] + counts[:, 1] + counts[:, 3] + counts[:, 4]) > 0;
+	pair_a = (pair_keys[connected] // variant_count) + first_variant;
+	pair_b = (pair_keys[connected] % variant_count) + first_variant;
+
+	return([pair_a, pair_b, counts[connected]]);
+
+def long_read_window_pairs(entry_reads, entry_columns, first_variant, variant_count):
+	global var_store;
+
+	# variants are only connected to those within the window of them on a read, so the cost is linear in the variants per read
+	# the slots each read has at a variant are kept as bits, a read is counted for every allele it has at a variant
+	read_variant_keys, entry_index = numpy.unique((entry_reads * variant_count) + (entry_columns // 3), return_inverse=True);
+	read_slot_bits = numpy.bincount(entry_index, weights=numpy.left_shift(1, entry_columns % 3), minlength=len(read_variant_keys)).astype(numpy.int64);
+	reads = read_variant_keys // variant_count;
+	variants = read_variant_keys % variant_count;
+
+	# the variants of each read by position
+	read_order = numpy.lexsort((variants, var_store.pos[variants + first_variant], reads));
+	reads = reads[read_order];
+	variants = variants[read_order];
+	read_slot_bits = read_slot_bits[read_order];
+
+	pair_keys = [];
+	pair_slots = [];
+	for offset in range(1, args.long_read_window + 1):
+		if offset >= len(reads): break;
+		same_read = numpy.flatnonzero(reads[:-offset] == reads[offset:]);
+		if len(same_read) == 0: break;
+		var_a = variants[same_read];
+		var_b = variants[same_read + offset];
+		bits_a = read_slot_bits[same_read];
+		bits_b = read_slot_bits[same_read + offset];
+
+		# keep the lower variant index first
+		swap = var_a > var_b;
+		var_a, var_b = numpy.where(swap, var_b, var_a), numpy.where(swap, var_a, var_b);
+		bits_a, bits_b = numpy.where(swap, bits_b, bits_a), numpy.where(swap, bits_a, bits_b);
+
+		for slot_a in range(0,3):
+			for slot_b in range(0,3):
+				has_slots = ((bits_a >> slot_a) & 1 & (bits_b >> slot_b)) == 1;
+				pair_keys.append((var_a[has_slots] * variant_count) + var_b[has_slots]);
+				pair_slots.append(numpy.full(int(has_slots.sum()), (slot_a * 3) + slot_b, dtype=numpy.int64));
+
+	pair_keys = numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + pair_keys);
+	pair_slots = numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + pair_slots);
+
+	return([pair_keys, pair_slots, numpy.ones(len(pair_keys), dtype=numpy.int64)]);
 
 def process_mapping_result(input):
-	global use_as_cutoff;
-	global as_cutoff;
-	global bam_index;
-	global haplo_count_bam_exclude;
-
-	dict_variant_reads = collections.OrderedDict()
-	read_vars = collections.OrderedDict()
+	global as_cutoffs;
 
-	stream_in = open(input, "r");
-	total_reads = 0;
-	chrom = "";
-	mapped_reads = 0;
+	# results for all the shards of a chromosome, in order, so that read pairs split across shards are merged
+	chrom = input[0];
+	mapper_table = input[1];
+	bam_count = len(as_cutoffs);
 
-	for line in stream_in:
-		fields = line.rstrip().split("\t");
-		#read_name	variant_id	rs_id	read_allele	alignment_score	genotype	maf
-		if use_as_cutoff == False or int(fields[4]) >= as_cutoff:
-			read_id = fields[0];
-			var_id = fields[1];
-			chrom = var_id.split(args.id_separator)[0];
-			read_allele = fields[3];
-
-			if var_id not in dict_variant_reads: dict_variant_reads[var_id] = generate_variant_dict(fields);
-
-			if read_allele in dict_variant_reads[var_id]['alleles']:
-				# add to the quick lookup dictionary
-				if read_id not in read_vars: read_vars[read_id] = [];
-				read_vars[read_id].append(var_id);
-
-				allele_index = dict_variant_reads[var_id]['alleles'].index(read_allele)
-				dict_variant_reads[var_id]['reads'][allele_index].append(read_id);
-				mapped_reads += 1;
-				if bam_index not in haplo_count_bam_exclude or len(haplo_count_bam_exclude) == 0:
-					if bam_index not in dict_variant_reads[var_id]['haplo_reads'][allele_index]: dict_variant_reads[var_id]['haplo_reads'][allele_index][bam_index] = [];
-					dict_variant_reads[var_id]['haplo_reads'][allele_index][bam_index].append(read_id);
-			else:
-				dict_variant_reads[var_id]['other_reads'].append(read_id);
-			total_reads += 1;
+	# the variant table holds the details of each variant, results refer to variants by row
+	stream_in = open(mapper_table, "r");
+	variant_table = [line.rstrip("\n").split("\t") for line in stream_in];
 	stream_in.close();
 
-	return([dict_variant_reads,read_vars,total_reads, chrom]);
+	# read names are interned to integers as they are ingested, the same name in any BAM gets the same id
+	dict_read_ids = {};
+	chrom_read_names = [];
+	# hash of each read name, used to pick the same reads at every variant when downsampling
+	read_hashes = [];
+
+	shard_records = [];
+	for result_file in input[2]:
+		records, shard_read_names = read_variant_map.load_mapping_result(result_file);
+
+		shard_read_ids = [];
+		for read_name in shard_read_names:
+			if read_name not in dict_read_ids:
+				dict_read_ids[read_name] = len(dict_read_ids);
+				if args.output_read_ids == 1: chrom_read_names.append(read_name);
+				if args.max_variant_depth > 0: read_hashes.append(zlib.crc32(read_name) & 0xffffffff);
+			shard_read_ids.append(dict_read_ids[read_name]);
+		del shard_read_names;
+
+		records['read'] = numpy.array(shard_read_ids, dtype=records['read'].dtype)[records['read']];
+		shard_records.append(records);
+
+	records = numpy.concatenate(shard_records);
+	del shard_records;
+	read_count = max([len(dict_read_ids), 1]);
+	del dict_read_ids;
+
+	# apply the alignment score cutoff of the BAM each read came from
+	if as_cutoffs.count(None) < bam_count:
+		bam_as_cutoffs = numpy.array([x if x != None else -numpy.inf for x in as_cutoffs]);
+		records = records[(records['as'] >= bam_as_cutoffs[records['bam']]) | (records['as'] == read_variant_map.as_missing)];
+
+	# process the BAMs one after another
+	if bam_count > 1:
+		records = records[numpy.argsort(records['bam'], kind='mergesort')];
+
+	bam_reads = numpy.bincount(records['bam'], minlength=bam_count).tolist();
+
+	# variants are numbered in the order they are first seen in the results
+	rows, first_records, record_variants = numpy.unique(records['variant'], return_index=True, return_inverse=True);
+	variant_order = numpy.argsort(first_records, kind='mergesort');
+	variant_rank = numpy.empty(len(rows), dtype=numpy.int64);
+	variant_rank[variant_order] = numpy.arange(len(rows));
+	record_variants = variant_rank[record_variants];
+	variant_rows = [parse_variant_row(variant_table[x]) for x in rows[variant_order].tolist()];
+	variant_count = len(variant_rows);
+	del variant_table;
+
+	# each read allele is put in a slot, 0 and 1 for the alleles of the individual and 2 for any other allele
+	slot_offsets = numpy.cumsum([0] + [len(x[8]) for x in variant_rows])[:-1];
+	slot_table = numpy.array([slot for x in variant_rows for slot in x[8]], dtype=numpy.int8);
+	allele_codes = records['allele'].astype(numpy.int64);
+	record_slots = numpy.full(len(records), 2, dtype=numpy.int64);
+	read_allele = allele_codes >= 0;
+	record_slots[read_allele] = slot_table[slot_offsets[record_variants[read_allele]] + allele_codes[read_allele]];
+
+	reads = records['read'].astype(numpy.int64);
+	bams = records['bam'];
+	del records;
+	slot_keys = (record_variants * 3) + record_slots;
+
+	# exact counts for allelic counts and the noise estimate, taken before downsampling
+	slot_hits = numpy.bincount(slot_keys, minlength=variant_count * 3).reshape(variant_count, 3);
+	slot_reads = numpy.bincount(numpy.unique((slot_keys * read_count) + reads) // read_count, minlength=variant_count * 3).reshape(variant_count, 3);
+
+	downsampled = numpy.zeros(variant_count, dtype=bool);
+	if args.max_variant_depth > 0:
+		kept_hits, downsampled = downsample_variants(record_variants, reads, numpy.array(read_hashes, dtype=numpy.int64), variant_count, args.max_variant_depth);
+		slot_keys = slot_keys[kept_hits];
+		reads = reads[kept_hits];
+		bams = bams[kept_hits];
+
+	# store the hits of each variant together, by slot, keeping the order they were read in
+	hit_order = numpy.argsort(slot_keys, kind='mergesort');
+
+	columns = {};
+	columns['ids'] = [x[0] for x in variant_rows];
+	columns['rsids'] = [x[1] for x in variant_rows];
+	columns['all_alleles'] = [x[3] for x in variant_rows];
+	columns['pos'] = numpy.array([x[2] for x in variant_rows], dtype=numpy.int64);
+	columns['alleles'] = numpy.array([x[4] for x in variant_rows], dtype=numpy.int16).reshape(variant_count, 2);
+	columns['phase'] = numpy.array([x[5] for x in variant_rows], dtype=numpy.int8).reshape(variant_count, 2);
+	columns['maf'] = numpy.array([x[6] for x in variant_rows], dtype=numpy.float64);
+	columns['haplo_blacklisted'] = numpy.array([x[7] for x in variant_rows], dtype=bool);
+	columns['read_counts'] = slot_reads[:, 0:2];
+	columns['noise_counts'] = numpy.column_stack([slot_hits[:, 0] + slot_hits[:, 1], slot_hits[:, 2]]);
+	columns['downsampled'] = downsampled;
+	columns['hit_counts'] = numpy.bincount(slot_keys, minlength=variant_count * 3).reshape(variant_count, 3);
+	columns['hit_reads'] = reads[hit_order].astype(numpy.int32);
+	columns['hit_bams'] = bams[hit_order];
+
+	# read sets of each slot, as sorted unique read ids
+	set_entries = numpy.unique((slot_keys * read_count) + reads);
+	columns['set_counts'] = numpy.bincount(set_entries // read_count, minlength=variant_count * 3).reshape(variant_count, 3);
+	columns['set_reads'] = (set_entries % read_count).astype(numpy.int32);
+
+	if args.output_read_ids != 1: chrom_read_names = None;
+
+	return([columns,bam_reads,chrom,chrom_read_names,int(downsampled.sum())]);
+
+def downsample_variants(record_variants, reads, read_hashes, variant_count, max_depth):
+	# keep the max_depth reads with the lowest name hashes, so that the reads kept at one variant are also kept at its neighbours
+	# the same hash cutoff is used for every allele, so allele ratios are not changed
+	read_count = max([len(read_hashes), 1]);
+	variant_reads = numpy.unique((record_variants * read_count) + reads);
+	read_variants = variant_reads // read_count;
+	variant_hashes = read_hashes[variant_reads % read_count];
+
+	variant_depths = numpy.bincount(read_variants, minlength=variant_count);
+	downsampled = variant_depths > max_depth;
+
+	# the hash of the max_depth-th read of each downsampled variant is its cutoff
+	variant_hashes = variant_hashes[numpy.lexsort((variant_hashes, read_variants))];
+	variant_starts = numpy.cumsum(variant_depths) - variant_depths;
+	hash_cutoffs = numpy.full(variant_count, numpy.iinfo(numpy.int64).max, dtype=numpy.int64);
+	hash_cutoffs[downsampled] = variant_hashes[variant_starts[downsampled] + max_depth - 1];
+
+	return([read_hashes[reads] <= hash_cutoffs[record_variants], downsampled]);
+
+def read_id_names(chrom, read_ids):
+	global read_names;
+
+	# translate interned read ids back to the original read names
+	return([read_names[chrom][x] for x in read_ids]);
 
 def call_mapping_script(input):
 	global args;
 	global devnull;
 
 	chrom = input[0];
-	bed_out = input[1];
-	mapper_out = input[2];
-	samtools_arg = input[3];
-	bam = input[4];
-	mapq = input[5];
-	isize = input[6];
+	mapper_out = input[1];
+	start = input[2];
+	table_offset = input[4];
+	table_row = input[5];
+	shard_index = input[6];
+	intervals = input[7];
+	shard_count = input[8];
+	bam_settings = input[9];
 
 	mapping_result = tempfile.NamedTemporaryFile(delete=False);
 	mapping_result.close();
 
-	#Save error code from subprocess if not 0, file it writes is truncated and gives unexpected wrong results.
-	run_cmd = "samtools view -h "+bam+" '"+chrom+"': | samtools view -Sh "+samtools_arg+" -L "+bed_out+" -q "+mapq+" - | "+args.python_string+" "+return_script_path()+"/call_read_variant_map.py --baseq "+str(args.baseq)+" --splice 1 --isize_cutoff "+str(isize)+" --variant_table "+mapper_out+" --o "+mapping_result.name
-	error_code = subprocess.check_call("set -euo pipefail && "+run_cmd, stdout=devnull, shell=True, executable='/bin/bash')
-	if error_code != 0:
-		raise RuntimeError("subprocess.call of call_read_variant_map.py exited with an error, with call: %s"%(run_cmd))
+	# fetch the reads overlapping the het sites of this window of the chromosome from each BAM and map them to alleles in process
+	# dups are removed if necessary, and only properly paired reads (ie in correct orientation) are used for paired end data
+	as_histograms, bam_metrics = read_variant_map.do_read_variant_map_bam(bam_settings, chrom, start, intervals, mapper_out, table_offset, table_row, args.baseq, mapping_result.name, 1, args.remove_dups, args.reference);
 
-	fun_flush_print("               completed chromosome %s..."%(chrom));
+	if shard_count > 1:
+		fun_flush_print("               completed chromosome %s window %d of %d..."%(chrom,shard_index+1,shard_count));
+	else:
+		fun_flush_print("               completed chromosome %s..."%(chrom));
 
-	return(mapping_result.name);
+	return([mapping_result.name, as_histograms, bam_metrics]);
 
-def generate_mapping_table(input):
-	global args;
-	global temp_files;
+def write_mapping_metrics(metrics_file, mapping_files, shard_metrics, bam_names):
+	stream_out = open(metrics_file, "w");
+	stream_out.write("\t".join(["contig","window","start","stop","intervals","bam"] + read_variant_map.metric_names + ["reads_per_second"])+"\n");
 
-	chrom = input[0];
-	chrom = args.chr_prefix + chrom;
+	total_reads = 0;
+	total_seconds = 0;
+	for shard, bam_metrics in zip(mapping_files, shard_metrics):
+		chrom, start, stop, shard_index, intervals = shard[0], shard[2], shard[3], shard[6], shard[7];
+
+		for bam_index in range(0, len(bam_metrics)):
+			metrics = bam_metrics[bam_index];
+			if metrics['wall_seconds'] > 0:
+				reads_per_second = metrics['reads_fetched'] / metrics['wall_seconds'];
+			else:
+				reads_per_second = 0;
+			metrics['map_seconds'] = round(metrics['map_seconds'], 3);
+			metrics['wall_seconds'] = round(metrics['wall_seconds'], 3);
+			fields_out = [chrom, shard_index+1, start, stop, len(intervals), bam_names[bam_index]] + [metrics[x] for x in read_variant_map.metric_names] + [int(reads_per_second)];
+			stream_out.write("\t".join(map(str, fields_out))+"\n");
+
+			total_reads += metrics['reads_fetched'];
+			total_seconds += metrics['wall_seconds'];
+	stream_out.close();
 
-	vcf_lines = input[1];
-	bed_out = tempfile.NamedTemporaryFile(delete=False, mode='wt');
-	mapper_out = tempfile.NamedTemporaryFile(delete=False, mode='wt');
-	het_count = 0;
-	total_indels_excluded = 0;
+	if total_seconds > 0:
+		fun_flush_print("     fetched %d reads at %d reads per second per thread"%(total_reads,total_reads/total_seconds));
 
-	temp_files.append(bed_out.name);
-	temp_files.append(mapper_out.name);
-
-	for vcf_columns in vcf_lines:
-		pos = vcf_columns[1];
-		rs_id = vcf_columns[2];
-		alt_alleles = vcf_columns[4].split(",");
-		all_alleles = [vcf_columns[3]] + alt_alleles;
-		unique_id = chrom+args.id_separator+pos+args.id_separator+(args.id_separator.join(all_alleles));
-
-		geno_string = vcf_columns[9];
-		genotype = vcf_columns[10];
-
-		maf = None;
-		if args.gw_phase_method == 1:
-			info_fields = annotation_to_dict(vcf_columns[7])
-			if args.gw_af_field in info_fields:
-				# make sure to get the right index if multi-allelic site
-				afs = map(float, info_fields[args.gw_af_field].split(","));
-
-				# make sure that there are the same number of allele frequencies as alternative variants
-				if len(afs) == len(alt_alleles):
-					use_afs = [];
-					for allele in list(genotype):
-						if allele != "." and int(allele) != 0:
-							use_afs.append(int(allele) - 1);
-					# if there are multiple alternative alleles use the lowest MAF
-					if len(use_afs) > 0:
-						maf = min([min([afs[x],1-afs[x]]) for x in use_afs]);
-
-		max_allele_size = max([len(x) for x in all_alleles]);
-
-		if (max_allele_size == 1 or args.include_indels == 1):
-
-			mapper_out.write("\t".join([chrom,vcf_columns[1], unique_id, rs_id,
-										",".join(all_alleles), str(len(vcf_columns[3])),
-										geno_string, str(maf)]) + "\n")
-			bed_out.write("\t".join([chrom, str(int(vcf_columns[1]) - 1), vcf_columns[1]]) + "\n");
-			het_count += 1;
-		else:
-			total_indels_excluded += 1;
+def mapping_table_row(chrom, vcf_columns, geno_string, genotype, haplo_blacklisted):
+	# returns the variant mapping table line for a het site, or None if it is an indel that is excluded
+	pos = vcf_columns[1];
+	rs_id = vcf_columns[2];
+	alt_alleles = vcf_columns[4].split(",");
+	all_alleles = [vcf_columns[3]] + alt_alleles;
 
-	bed_out.close();
-	mapper_out.close();
+	max_allele_size = max([len(x) for x in all_alleles]);
+	if max_allele_size > 1 and args.include_indels == 0:
+		return(None);
+
+	unique_id = chrom+args.id_separator+pos+args.id_separator+(args.id_separator.join(all_alleles));
+
+	maf = None;
+	if args.gw_phase_method == 1:
+		info_fields = annotation_to_dict(vcf_columns[7])
+		if args.gw_af_field in info_fields:
+			# make sure to get the right index if multi-allelic site
+			afs = map(float, info_fields[args.gw_af_field].split(","));
+
+			# make sure that there are the same number of allele frequencies as alternative variants
+			if len(afs) == len(alt_alleles):
+				use_afs = [];
+				for allele in list(genotype):
+					if allele != "." and int(allele) != 0:
+						use_afs.append(int(allele) - 1);
+				# if there are multiple alternative alleles use the lowest MAF
+				if len(use_afs) > 0:
+					maf = min([min([afs[x],1-afs[x]]) for x in use_afs]);
+
+	return("\t".join([chrom, pos, unique_id, rs_id, ",".join(all_alleles), str(len(vcf_columns[3])), geno_string, str(maf), str(int(haplo_blacklisted))]) + "\n");
+
+def mapping_shards(spans, shard_size):
+	# reads are only fetched from [start, stop) intervals around the het sites, sites closer than this are fetched as one interval
+	interval_merge_distance = 1000;
+
+	# read mapping shards, [start, stop, table offset, table row, index, intervals]
+	# a read belongs to the first interval it overlaps, start is the stop of the previous shard and stop the end of its last interval
+	shards = [[0, 0, 0, 0, 0, []]];
+
+	for het_count, (variant_start, variant_stop, table_offset) in enumerate(spans.tolist()):
+		if shard_size > 0 and het_count > 0 and het_count % shard_size == 0 and variant_start >= shards[-1][1]:
+			# start a new shard at this variant
+			shards.append([shards[-1][1], shards[-1][1], table_offset, het_count, len(shards), []]);
+
+		intervals = shards[-1][5];
+		if len(intervals) > 0 and variant_start - intervals[-1][1] <= interval_merge_distance:
+			intervals[-1][1] = max([intervals[-1][1], variant_stop]);
+		else:
+			intervals.append([variant_start, variant_stop]);
+		shards[-1][1] = intervals[-1][1];
 
-	return([chrom, het_count, total_indels_excluded, bed_out.name, mapper_out.name]);
+	return(shards);
 
 def return_script_path():
 	return os.path.dirname(os.path.realpath(sys.argv[0]));
 
-def generate_variant_dict(fields):
-	#read_name	variant_id	rs_id	read_allele	alignment_score	genotype	maf
-	id_split = fields[1].split(args.id_separator);
-	all_alleles = id_split[2:len(id_split)];
+def parse_variant_row(variant_columns):
+	#chr	pos	unique_id	rs_id	alleles	ref_length	genotype	maf	haplo_blacklisted
+	all_alleles = variant_columns[4].split(",");
 
-	genotype = list(fields[5]);
+	genotype = list(variant_columns[6]);
 	is_phased = 0;
 	if "|" in genotype:
 		genotype.remove("|");
 		is_phased = 1;
 	if "/" in genotype: genotype.remove("/");
 
-	# get only the alleles this individual has
-	ind_alleles = [];
+	# get only the alleles this individual has, as their index in the VCF alleles
+	allele_codes = [];
 
 	for i in range(0,len(all_alleles)):
 		if str(i) in genotype:
-			ind_alleles.append(all_alleles[i]);
+			allele_codes.append(i);
+	ind_alleles = [all_alleles[x] for x in allele_codes];
 
-	# get phasing
-	phase = [];
+	# get phasing, as the side of the genotype each allele is on
 	if is_phased == 1:
-		for index in genotype:
-			phase.append(all_alleles[int(index)]);
+		phase = [all_alleles[int(index)] for index in genotype];
+		allele_phase = [phase.index(x) for x in ind_alleles];
 	else:
-		phase = ["-","-"];
+		allele_phase = [-1, -1];
 
-	maf = fields[6];
+	# maf is stored as nan when it is missing
+	maf = variant_columns[7];
 	try:
 		maf = float(maf);
 	except:
-		maf = 0;
+		maf = float('nan');
 
 	# if rsid is "." or "" then set rsID to the uniqueID
-	if fields[2] != "." and fields[2] != "":
-		rsid = fields[2];
+	if variant_columns[3] != "." and variant_columns[3] != "":
+		rsid = variant_columns[3];
 	else:
-		rsid = fields[1];
-
-	return collections.OrderedDict(
-		[("id", fields[1]), ("rsid", rsid), ("ref", all_alleles[0]),
-		 ("chr", id_split[0]), ("pos", int(id_split[1])), ("alleles", ind_alleles),
-		 ("phase", phase), ("gw_phase", phase), ("maf", maf), ("other_reads", []),
-		 ("reads", [[] for i in range(len(ind_alleles))]),
-		 ("haplo_reads", [collections.OrderedDict() for i in range(len(ind_alleles))])])
-
-	#return({"id":fields[1], "rsid":rsid,"ref":all_alleles[0],"chr":id_split[0],"pos":int(id_split[1]),"alleles":ind_alleles,"phase":phase, "gw_phase":phase, "maf":maf, "other_reads":[], "reads":[[] for i in range(len(ind_alleles))], "haplo_reads":[{} for i in range(len(ind_alleles))]});
+		rsid = variant_columns[2];
+
+	# slot that a read with each of the VCF alleles is counted in, 2 = other allele
+	allele_slots = [ind_alleles.index(x) if x in ind_alleles else 2 for x in all_alleles];
+
+	return([variant_columns[2], rsid, int(variant_columns[1]), variant_columns[4], allele_codes, allele_phase, maf, variant_columns[8] == "1", allele_slots]);
+
+class variant_store:
+	# heterozygous variants as columns indexed by a dense integer variant index, the variants of each chromosome are contiguous
+	# the hits of each variant are stored together by slot, 0 and 1 for the alleles of the individual and 2 for other alleles
+	# the read set of each slot is stored the same way, as sorted unique read ids, so whole chromosomes are single arrays that forked workers share without copying
+	list_columns = ['ids','rsids','all_alleles'];
+	array_columns = [('chrom',numpy.int32,1),('pos',numpy.int64,1),('alleles',numpy.int16,2),('phase',numpy.int8,2),('gw_phase',numpy.int8,2),('maf',numpy.float64,1),('haplo_blacklisted',bool,1),('read_counts',numpy.int64,2),('noise_counts',numpy.int64,2),('downsampled',bool,1),('hit_counts',numpy.int64,3),('set_counts',numpy.int64,3)];
+	# columns with an entry per hit or read set member, and the column with the number of entries in each slot
+	entry_columns = [('hit_reads',numpy.int32,'hit_counts'),('hit_bams',numpy.uint16,'hit_counts'),('set_reads',numpy.int32,'set_counts')];
+
+	def __init__(self, contigs, columns):
+		self.contigs = contigs;
+		for name in variant_store.list_columns:
+			setattr(self, name, columns[name]);
+		for name, dtype, width in variant_store.array_columns:
+			if name == 'gw_phase' and name not in columns:
+				# genome wide phase of each allele, set when blocks are output, -1 = unknown
+				columns[name] = numpy.full((len(self.ids), 2), -1, dtype=dtype);
+			setattr(self, name, columns[name]);
+		for name, dtype, counts in variant_store.entry_columns:
+			setattr(self, name, columns[name]);
+
+		self.hit_offsets = numpy.concatenate([[0], numpy.cumsum(self.hit_counts.ravel())]).astype(numpy.int64);
+		self.set_offsets = numpy.concatenate([[0], numpy.cumsum(self.set_counts.ravel())]).astype(numpy.int64);
+		self.index = dict(zip(self.ids, range(len(self.ids))));
+
+	def __len__(self):
+		return(len(self.ids));
+
+	def chr(self, var_index):
+		return(self.contigs[self.chrom[var_index]]);
+
+	def allele(self, var_index, allele_index):
+		return(self.all_alleles[var_index].split(",")[self.alleles[var_index][allele_index]]);
+
+	def maf_value(self, var_index):
+		# a missing maf counts as 0
+		maf = float(self.maf[var_index]);
+		if math.isnan(maf):
+			return(0);
+		else:
+			return(maf);
+
+	def reads(self, var_index, slot, bam=None):
+		# read ids for a slot of a variant, in the order they were read, optionally from a single BAM
+		start = self.hit_offsets[(var_index * 3) + slot];
+		stop = self.hit_offsets[(var_index * 3) + slot + 1];
+		if bam == None:
+			return(self.hit_reads[start:stop].tolist());
+		else:
+			return(self.hit_reads[start:stop][self.hit_bams[start:stop] == bam].tolist());
+
+	def read_set(self, var_index, slot):
+		return(self.set_reads[self.set_offsets[(var_index * 3) + slot]:self.set_offsets[(var_index * 3) + slot + 1]]);
+
+	def chrom_range(self, chrom):
+		# first and last + 1 index of the variants of a contig
+		chrom_code = self.contigs.index(chrom);
+		return([int(numpy.searchsorted(self.chrom, chrom_code, 'left')), int(numpy.searchsorted(self.chrom, chrom_code, 'right'))]);
+
+	def shared_read_count(self, var_a, slot_a, var_b, slot_b):
+		# size of the intersection of two read sets
+		reads_a = self.read_set(var_a, slot_a);
+		reads_b = self.read_set(var_b, slot_b);
+		if len(reads_a) == 0 or len(reads_b) == 0:
+			return(0);
+		found = numpy.minimum(numpy.searchsorted(reads_b, reads_a), len(reads_b) - 1);
+		return(int(numpy.count_nonzero(reads_b[found] == reads_a)));
+
+	def subset(self, keep):
+		# new store with only the variants where keep is true, in the same order
+		kept = numpy.flatnonzero(keep).tolist();
+		columns = {};
+		for name in variant_store.list_columns:
+			columns[name] = [getattr(self, name)[x] for x in kept];
+		for name, dtype, width in variant_store.array_columns:
+			columns[name] = getattr(self, name)[keep];
+		for name, dtype, counts in variant_store.entry_columns:
+			columns[name] = getattr(self, name)[numpy.repeat(numpy.repeat(keep, 3), getattr(self, counts).ravel())];
+
+		return(variant_store(self.contigs, columns));
+
+def build_variant_store(chrom_columns):
+	# stack the columns of each chromosome, in order
+	contigs = [x[0] for x in chrom_columns];
+	columns = {};
+	for name in variant_store.list_columns:
+		columns[name] = list(itertools.chain.from_iterable([x[1][name] for x in chrom_columns]));
+	columns['chrom'] = numpy.repeat(numpy.arange(len(contigs), dtype=numpy.int32), [len(x[1]['ids']) for x in chrom_columns]);
+	for name, dtype, width in variant_store.array_columns:
+		if name != 'chrom' and name != 'gw_phase':
+			shape = (0,) if width == 1 else (0, width);
+			columns[name] = numpy.concatenate([numpy.zeros(shape, dtype=dtype)] + [x[1][name] for x in chrom_columns]).astype(dtype);
+	for name, dtype, counts in variant_store.entry_columns:
+		columns[name] = numpy.concatenate([numpy.zeros(0, dtype=dtype)] + [x[1][name] for x in chrom_columns]).astype(dtype);
+
+	return(variant_store(contigs, columns));
 
 def phase_block_container(input):
 	#stream_out = open(input[0],"w");
@@ -1590,67 +2142,52 @@ def test_loop_back(block):
 	else:
 		return(1);
 
-def test_variant_connection(input):
+def test_variant_connections(pair_a, pair_b, counts):
 	global noise_e;
-	global dict_variant_reads;
-
-	chr, variant_a, variant_b = input;
+	global var_store;
 
+	# tests every connected pair of a chromosome at once
+	# evidence was counted from the reads when building the connectivity map, as [a allele * 3 + b allele], with alleles 0, 1 and 2 = other
 	# there are only two possible configurations, determine evidence for each
 	# a[ref]b[ref] | a[alt]b[alt]
-	hap_config_a_support = len(dict_variant_reads[variant_a]['read_set'][0] & dict_variant_reads[variant_b]['read_set'][0]) + len(dict_variant_reads[variant_a]['read_set'][1] & dict_variant_reads[variant_b]['read_set'][1])
+	hap_config_a_support = counts[:, 0] + counts[:, 4];
 	# a[ref]b[alt] | a[alt]b[ref]
-	hap_config_b_support = len(dict_variant_reads[variant_a]['read_set'][1] & dict_variant_reads[variant_b]['read_set'][0]) + len(dict_variant_reads[variant_a]['read_set'][0] & dict_variant_reads[variant_b]['read_set'][1])
-
-	# determine if phasing is concordant with what as specified in the input VCF
-	phase_concordant = ".";
-	# make sure the input VCF had phase
-	if "-" not in dict_variant_reads[variant_a]['phase'] and "-" not in dict_variant_reads[variant_b]['phase']:
-		if hap_config_a_support > hap_config_b_support:
-
-			if dict_variant_reads[variant_a]['phase'].index(dict_variant_reads[variant_a]['alleles'][0]) == dict_variant_reads[variant_b]['phase'].index(dict_variant_reads[variant_b]['alleles'][0]):
-				phase_concordant = 1;
-			else:
-				phase_concordant = 0;
-		elif hap_config_a_support < hap_config_b_support:
-			if dict_variant_reads[variant_a]['phase'].index(dict_variant_reads[variant_a]['alleles'][1]) == dict_variant_reads[variant_b]['phase'].index(dict_variant_reads[variant_b]['alleles'][0]):
-				phase_concordant = 1;
-			else:
-				phase_concordant = 0;
+	hap_config_b_support = counts[:, 3] + counts[:, 1];
 
 	# also get the connections from reads where the bases did not match to either ref or alt
-	# a[other] -> b[ref]
-	other_base_connections = len(dict_variant_reads[variant_a]['other_read_set'] & dict_variant_reads[variant_b]['read_set'][0]);
-	# a[other] -> b[alt]
-	other_base_connections += len(dict_variant_reads[variant_a]['other_read_set'] & dict_variant_reads[variant_b]['read_set'][1]);
-	# a[ref] -> b[other]
-	other_base_connections += len(dict_variant_reads[variant_a]['read_set'][0] & dict_variant_reads[variant_b]['other_read_set']);
-	# a[alt] -> b[other]
-	other_base_connections += len(dict_variant_reads[variant_a]['read_set'][1] & dict_variant_reads[variant_b]['other_read_set']);
-	# a[other] -> b[other]
-	other_base_connections += len(dict_variant_reads[variant_a]['other_read_set'] & dict_variant_reads[variant_b]['other_read_set']);
-
-	c_supporting = max(hap_config_a_support,hap_config_b_support);
+	# a[other] -> b[ref], a[other] -> b[alt], a[ref] -> b[other], a[alt] -> b[other], a[other] -> b[other]
+	other_base_connections = counts[:, 6] + counts[:, 7] + counts[:, 2] + counts[:, 5] + counts[:, 8];
+
+	c_supporting = numpy.maximum(hap_config_a_support, hap_config_b_support);
 	c_total = hap_config_a_support + hap_config_b_support + other_base_connections;
 
-	if hap_config_a_support > hap_config_b_support:
-		chosen_config = 0;
-	elif hap_config_a_support < hap_config_b_support:
-		chosen_config = 1;
-	else:
-		chosen_config = -1;
+	chosen_config = numpy.full(len(counts), -1, dtype=numpy.int8);
+	chosen_config[hap_config_a_support > hap_config_b_support] = 0;
+	chosen_config[hap_config_a_support < hap_config_b_support] = 1;
+
+	# determine if phasing is concordant with what as specified in the input VCF, -1 where it can't be determined
+	phase_concordant = numpy.full(len(counts), -1, dtype=numpy.int8);
+	phase_a = var_store.phase[pair_a];
+	phase_b = var_store.phase[pair_b];
+	# make sure the input VCF had phase
+	input_phased = (phase_a[:, 0] >= 0) & (phase_b[:, 0] >= 0);
+	config_phased = numpy.where(chosen_config == 0, phase_a[:, 0] == phase_b[:, 0], phase_a[:, 1] == phase_b[:, 0]);
+	phase_concordant[input_phased & (chosen_config >= 0)] = config_phased[input_phased & (chosen_config >= 0)];
 
 	# if no reads support the phase then strip this connection
-	if c_supporting == 0:
-		conflicting_config_p = 0;
-	elif c_total - c_supporting > 0:
-		# otherwise do the test
-		conflicting_config_p = binom.cdf(c_supporting,c_total,1-((6*noise_e)+(10*math.pow(noise_e,2))));
-	else:
-		# only both doing the test if there are some conflicting reads
-		conflicting_config_p = 1;
+	# only both doing the test if there are some conflicting reads, otherwise the connection passes
+	conflicting_config_p = (c_supporting > 0).astype(numpy.float64);
+	tested = (c_supporting > 0) & (c_total - c_supporting > 0);
+	conflicting_config_p[tested] = cached_binom_cdf(c_supporting[tested], c_total[tested], 1-((6*noise_e)+(10*math.pow(noise_e,2))));
+
+	return([c_supporting, c_total, conflicting_config_p, tested, phase_concordant, chosen_config]);
 
-	return([chr,variant_a,variant_b,conflicting_config_p,c_supporting,c_total,phase_concordant,chosen_config]);
+def cached_binom_cdf(k, n, p):
+	# many pairs share the same read counts, so the cdf is only calculated once for each distinct (k, n)
+	if len(k) == 0:
+		return(numpy.zeros(0, dtype=numpy.float64));
+	kn_keys, kn_index = numpy.unique((n.astype(numpy.int64) << 32) + k, return_inverse=True);
+	return(binom.cdf(kn_keys & 0xffffffff, kn_keys >> 32, p)[kn_index]);
 
 def new_temp_file():
 	xfile = tempfile.NamedTemporaryFile(delete=False)
@@ -1660,7 +2197,7 @@ def new_temp_file():
 def write_vcf(out_prefix, chromosome_of_interest):
 	global args;
 	global haplotype_lookup;
-	global dict_variant_reads;
+	global var_store;
 	global haplotype_pvalue_lookup
 	global sample_column;
 	global csi_index;
@@ -1767,14 +2304,15 @@ def write_vcf(out_prefix, chromosome_of_interest):
 						alleles_out = [];
 						gw_phase_out = ["",""];
 						block_index = haplotype_lookup[unique_id][2];
+						var_index = var_store.index[unique_id];
 
 						for allele in haplotype_lookup[unique_id][1].split("|"):
-							allele_base = dict_variant_reads[unique_id]['alleles'][int(allele)];
+							allele_base = var_store.allele(var_index, int(allele));
 							vcf_allele_index = all_alleles.index(allele_base);
 
 							# get the genome wide phase
-							gw_phase = dict_variant_reads[unique_id]['gw_phase'][int(allele)]
-							if isinstance(gw_phase, int) == True:
+							gw_phase = var_store.gw_phase[var_index][int(allele)]
+							if gw_phase >= 0:
 								gw_phase_out[gw_phase] = str(vcf_allele_index);
 
 							alleles_out.append(str(vcf_allele_index));
@@ -1783,7 +2321,7 @@ def write_vcf(out_prefix, chromosome_of_interest):
 						variants_out = [];
 						for variant in haplotype_lookup[unique_id][0]:
 							# if ":" is in the rsid need to replace it, otherwise it will mess up output
-							variants_out.append(dict_variant_reads[variant]['rsid'].replace(":","_"));
+							variants_out.append(var_store.rsids[var_store.index[variant]].replace(":","_"));
 						# get the p-value, if there was one for the block
 						# pval = haplotype_pvalue_lookup[list_to_string(haplotype_lookup[unique_id][0])];
 						gw_stat = haplotype_gw_stat_lookup[list_to_string(haplotype_lookup[unique_id][0])];
@@ -1857,29 +2395,39 @@ def str_join(joiner,list):
 	list = map(str, list);
 	return(joiner.join(list));
 
-def build_haplotypes(input):
-	dict_variant_overlap = copy.deepcopy(input);
-	block_haplotypes = [];
-	total_hap_pool = len(dict_variant_overlap);
-	remaining_hap_pool = dict_variant_overlap;
-	set_remaining_hap_pool = set(dict_variant_overlap.keys());
-	while len(remaining_hap_pool) > 0:
-		# this will construct many iterations of the same haplotype need to filter it out;
-		# start the process with a variant pair;
-		seed_var = remaining_hap_pool.keys()[0];
-		seed = set([seed_var] + list(remaining_hap_pool[seed_var]));
-		del remaining_hap_pool[seed_var];
-		set_remaining_hap_pool.remove(seed_var);
-		result = build_haplotype_v3(seed,remaining_hap_pool,set_remaining_hap_pool);
-		new_hap = list(result[0]);
-		# sort by location
-		new_hap = sort_var_ids(new_hap);
-		remaining_hap_pool = result[1];
-		set_remaining_hap_pool = result[2];
-		block_haplotypes.append(new_hap);
+def build_haplotypes(variant_graph):
+	global var_store;
+
+	# blocks are the connected components of the variant graph, variants without any connections are left out
+	component_count, labels = scipy.sparse.csgraph.connected_components(variant_graph, directed=False);
+	in_block = numpy.bincount(labels, minlength=component_count)[labels] > 1;
+
+	# order the blocks by their first variant and the variants of each block by location
+	first_variants = numpy.unique(labels, return_index=True)[1];
+	block_rank = numpy.argsort(numpy.argsort(first_variants))[labels];
+	variant_order = numpy.lexsort((numpy.arange(len(labels)), var_store.pos, block_rank));
+	variant_order = variant_order[in_block[variant_order]];
+
+	block_starts = numpy.flatnonzero(numpy.diff(block_rank[variant_order])) + 1;
+	block_haplotypes = numpy.split(variant_order, block_starts) if len(variant_order) > 0 else [];
 
 	return(block_haplotypes);
 
+def build_connection_graphs(variant_count, link_a, link_b, link_config):
+	# adjacency of the variants and of their alleles, held as CSR matrices with each connection stored from both sides
+	# variants are connected by every pair which passed the conflicting configuration test
+	variant_graph = scipy.sparse.csr_matrix((numpy.ones(len(link_a) * 2, dtype=numpy.int8), (numpy.concatenate([link_a, link_b]), numpy.concatenate([link_b, link_a]))), shape=(variant_count, variant_count));
+
+	# allele nodes are numbered 2 * variant index + allele, a pair with a chosen configuration links the alleles on the same haplotype
+	# 0 - 0 / 1 - 1 for configuration 0, 0 - 1 / 1 - 0 for configuration 1
+	configured = link_config >= 0;
+	config = link_config[configured].astype(numpy.int64);
+	node_a = numpy.concatenate([2 * link_a[configured], (2 * link_a[configured]) + 1]);
+	node_b = numpy.concatenate([(2 * link_b[configured]) + config, (2 * link_b[configured]) + 1 - config]);
+	allele_graph = scipy.sparse.csr_matrix((numpy.ones(len(node_a) * 2, dtype=numpy.int8), (numpy.concatenate([node_a, node_b]), numpy.concatenate([node_b, node_a]))), shape=(variant_count * 2, variant_count * 2));
+
+	return([variant_graph, allele_graph]);
+
 def sort_var_ids(ids):
 	xsplit = [x.split(args.id_separator) for x in ids];
 	xsort = sorted(xsplit, key = lambda x: (x[0], int(x[1])))
@@ -1887,7 +2435,7 @@ def sort_var_ids(ids):
 
 def count_hap_junctions(block):
 	counted = set([]);
-	reads = [];
+	read_count = 0;
 
 	for var_index in range(0,len(block)):
 		for var_allele in range(0,2):
@@ -1895,9 +2443,9 @@ def count_hap_junctions(block):
 				if other_index != var_index:
 					for other_allele in range(0,2):
 						if (str(var_index)+":"+str(var_allele)+":"+str(other_index)+":"+str(other_allele) not in counted) and (str(other_index)+":"+str(other_allele)+":"+str(var_index)+":"+str(var_allele) not in counted):
-							reads += list(dict_variant_reads[block[var_index]]['read_set'][var_allele] & dict_variant_reads[block[other_index]]['read_set'][other_allele]);
+							read_count += var_store.shared_read_count(var_store.index[block[var_index]], var_allele, var_store.index[block[other_index]], other_allele);
 							counted.add(str(var_index)+":"+str(var_allele)+":"+str(other_index)+":"+str(other_allele));
-	return([block,len(reads)]);
+	return([block,read_count]);
 
 def count_hap_reads(input):
 	block = input[0];
@@ -1909,9 +2457,9 @@ def count_hap_reads(input):
 		parent_block = input[2];
 		block_number = input[3];
 
-	global dict_variant_reads;
+	global var_store;
 
-	reads = [];
+	read_count = 0;
 	counted = set([]);
 	# sum up supporting reads between all configs
 	for var_index in range(0,len(block)):
@@ -1919,17 +2467,17 @@ def count_hap_reads(input):
 			if other_index != var_index:
 				if (str(var_index)+":"+str(other_index) not in counted) and (str(other_index)+":"+str(var_index) not in counted):
 					# the noise test should be done here, only pairs where the signal is above noise should be counted.
-					reads += list(dict_variant_reads[block[var_index]]['read_set'][int(configuration[var_index])] & dict_variant_reads[block[other_index]]['read_set'][int(configuration[other_index])]);
+					read_count += var_store.shared_read_count(var_store.index[block[var_index]], int(configuration[var_index]), var_store.index[block[other_index]], int(configuration[other_index]));
 					counted.add(str(var_index)+":"+str(other_index));
 
-	return([block, configuration, len(reads), parent_block, block_number]);
+	return([block, configuration, read_count, parent_block, block_number]);
 
 def generate_hap_network_all(input):
 	block = input;
 
-	global dict_variant_reads;
+	global var_store;
 
-	reads = [];
+	block_indexes = [var_store.index[x] for x in block];
 	counted = set([]);
 
 	out_junctions = [];
@@ -1940,9 +2488,11 @@ def generate_hap_network_all(input):
 				for allele_index in range (0,2):
 					for other_allele_index in range(0,2):
 						if (str(var_index)+":"+str(allele_index)+":"+str(other_index)+":"+str(other_allele_index) not in counted) and (str(other_index)+":"+str(other_allele_index)+":"+str(var_index)+":"+str(allele_index) not in counted):
-							junctions = list(dict_variant_reads[block[var_index]]['read_set'][allele_index] & dict_variant_reads[block[other_index]]['read_set'][other_allele_index]);
-							out_junctions.append([dict_variant_reads[block[var_index]]['id']+":"+dict_variant_reads[block[var_index]]['alleles'][allele_index],dict_variant_reads[block[other_index]]['id']+":"+dict_variant_reads[block[other_index]]['alleles'][other_allele_index], len(junctions), 0]);
-							out_junctions.append([dict_variant_reads[block[var_index]]['id']+":"+dict_variant_reads[block[var_index]]['alleles'][int(not allele_index)],dict_variant_reads[block[other_index]]['id']+":"+dict_variant_reads[block[other_index]]['alleles'][int(not other_allele_index)], len(junctions), 1]);
+							var_a = block_indexes[var_index];
+							var_b = block_indexes[other_index];
+							junctions = var_store.shared_read_count(var_a, allele_index, var_b, other_allele_index);
+							out_junctions.append([block[var_index]+":"+var_store.allele(var_a,allele_index),block[other_index]+":"+var_store.allele(var_b,other_allele_index), junctions, 0]);
+							out_junctions.append([block[var_index]+":"+var_store.allele(var_a,int(not allele_index)),block[other_index]+":"+var_store.allele(var_b,int(not other_allele_index)), junctions, 1]);
 							counted.add(str(var_index)+":"+str(allele_index)+":"+str(other_index)+":"+str(other_allele_index));
 
 	return([out_junctions, block]);
@@ -1951,9 +2501,9 @@ def generate_hap_network(input):
 	block = input[0];
 	configuration = input[1];
 
-	global dict_variant_reads;
+	global var_store;
 
-	reads = [];
+	block_indexes = [var_store.index[x] for x in block];
 	counted = set([]);
 
 	out_junctions = [];
@@ -1967,18 +2517,23 @@ def generate_hap_network(input):
 					## SHOULD FIRST CHECK TO MAKE SURE THIS ISN'T A READ PAIR THAT FAILED THE TEST
 					# actually I don't think this matters, it will always choose the most supported phase
 
-					junctions = list(dict_variant_reads[block[var_index]]['read_set'][int(configuration[var_index])] & dict_variant_reads[block[other_index]]['read_set'][int(configuration[other_index])]);
-					out_junctions.append([dict_variant_reads[block[var_index]]['rsid']+":"+dict_variant_reads[block[var_index]]['alleles'][int(configuration[var_index])],dict_variant_reads[block[other_index]]['rsid']+":"+dict_variant_reads[block[other_index]]['alleles'][int(configuration[other_index])], len(junctions), 0]);
-					out_junctions.append([dict_variant_reads[block[var_index]]['rsid']+":"+dict_variant_reads[block[var_index]]['alleles'][int(not int(configuration[var_index]))],dict_variant_reads[block[other_index]]['rsid']+":"+dict_variant_reads[block[other_index]]['alleles'][int(not int(configuration[other_index]))], len(junctions), 1]);
+					var_a = block_indexes[var_index];
+					var_b = block_indexes[other_index];
+					junctions = var_store.shared_read_count(var_a, int(configuration[var_index]), var_b, int(configuration[other_index]));
+					out_junctions.append([var_store.rsids[var_a]+":"+var_store.allele(var_a,int(configuration[var_index])),var_store.rsids[var_b]+":"+var_store.allele(var_b,int(configuration[other_index])), junctions, 0]);
+					out_junctions.append([var_store.rsids[var_a]+":"+var_store.allele(var_a,int(not int(configuration[var_index]))),var_store.rsids[var_b]+":"+var_store.allele(var_b,int(not int(configuration[other_index]))), junctions, 1]);
 					counted.add(str(var_index)+":"+str(other_index));
 
 	return([out_junctions, block, configuration]);
 
-def get_allele_phase(allele, var_dict):
+def get_allele_phase(var_index, allele_index):
+	global var_store;
 
-	try:
-		return(var_dict['phase'].index(allele));
-	except:
+	# side of the input VCF genotype the allele is on, nan if the input was unphased
+	phase = var_store.phase[var_index][allele_index];
+	if phase >= 0:
+		return(int(phase));
+	else:
 		return(float('nan'));
 
 def build_haplotype_v3(set_haplotype, dict_all_associations, set_all_associations):
@@ -1999,6 +2554,29 @@ def build_haplotype_v3(set_haplotype, dict_all_associations, set_all_association
 def get_var_pos(var_fields):
 	return(int(var_fields.split(":")[0]));
 
+def histogram_percentile(histogram, q):
+	# percentile of the values counted in a {value:count} histogram, interpolated the same way as numpy.percentile
+	values = sorted(histogram.keys());
+	total = sum(histogram.values());
+
+	rank = (float(q) / 100) * (total - 1);
+	index_below = int(math.floor(rank));
+	index_above = min([index_below + 1, total - 1]);
+	weight_above = rank - index_below;
+
+	# find the values at both ranks by walking the cumulative counts
+	value_below = None;
+	value_above = None;
+	cumulative = 0;
+	for value in values:
+		cumulative += histogram[value];
+		if value_below == None and cumulative > index_below: value_below = value;
+		if cumulative > index_above:
+			value_above = value;
+			break;
+
+	return((value_below * (1 - weight_above)) + (value_above * weight_above));
+
 def list_to_string(xlist,sep=","):
 	string_out = "";
 	for item in xlist:
@@ -2078,7 +2656,7 @@ def parallelize(function, pool_input):
 
 	if len(pool_input) > 0:
 		threads = min([len(pool_input),args.threads]);
-		if args.threads > 1:
+		if threads > 1:
 			pool = multiprocessing.Pool(processes=threads);
 			pool_output = pool.map(function, pool_input);
 			pool.close() # no more tasks
@@ -2105,9 +2683,15 @@ def annotation_to_dict(text,sep=";"):
 
 def phase_v3(input):
 	global args;
-	variants = input[0];
-	variant_connections = input[1];
-	allele_connections = input[2];
+	global variant_graph;
+	global allele_graph;
+
+	# the block is phased on local variant indexes, with the connections between its variants and alleles taken from the graphs
+	block_variants = input;
+	block_nodes = numpy.column_stack([2 * block_variants, (2 * block_variants) + 1]).ravel();
+	variant_connections = variant_graph[block_variants][:, block_variants];
+	allele_connections = allele_graph[block_nodes][:, block_nodes];
+	variants = range(0, len(block_variants));
 
 	# first check to see if haplotype is fully concordant
 	# if it is simply return the haplotype
@@ -2156,50 +2740,31 @@ def phase_v3(input):
 		final_blocks = split_phases + [final_phase];
 		do_print = 1;
 
+	# output the variant indexes of each phased block with its haplotype
 	out_phase = [];
 	variant_index = 0;
 	for block in final_blocks:
-		out_block = [];
-		for allele in block[0]:
-			out_block.append(variants[variant_index]+":"+allele)
-			variant_index += 1;
-		if "-" not in out_block[0].split(":")[1]:
-			out_phase.append(out_block);
+		out_block = block_variants[variant_index:variant_index+len(block[0])];
+		variant_index += len(block[0]);
+		if "-" not in block[0][0]:
+			out_phase.append([out_block, block[0]]);
 
 	return(out_phase);
 
-def resolve_phase(variants, allele_connections, clean_connections = False):
-
-	# if needed remove connections from allele_connections that are not in the variant list
-	if clean_connections == True:
-		set_variants = set(variants);
-		cleaned_connections = collections.OrderedDict()
-
-		for allele in allele_connections:
-			variant = allele.split(":")[0];
-			if variant in set_variants:
-				cleaned_connections[allele] = set([]);
-				for connection in allele_connections[allele]:
-					other_variant = connection.split(":")[0];
-					if other_variant in variants:
-						cleaned_connections[allele].add(connection);
-
-		allele_connections = cleaned_connections;
-
-	remaining_hap_pool = copy.deepcopy(allele_connections);
-	set_remaining_hap_pool = set(remaining_hap_pool.keys());
-	seed_var = remaining_hap_pool.keys()[0];
-	seed = set([seed_var] + list(remaining_hap_pool[seed_var]));
-	del remaining_hap_pool[seed_var];
-	set_remaining_hap_pool.remove(seed_var);
-	result = build_haplotype_v3(seed,remaining_hap_pool,set_remaining_hap_pool);
-	new_hap = list(result[0]);
-	if len(new_hap) == len(variants):
+def resolve_phase(variants, allele_connections):
+	# variants are a run of local indexes, only connections between their own alleles are used
+	first_node = 2 * variants[0];
+	last_node = 2 * (variants[-1] + 1);
+	component_count, labels = scipy.sparse.csgraph.connected_components(allele_connections[first_node:last_node, first_node:last_node], directed=False);
+
+	# the haplotype is everything connected to the first allele of the first variant
+	new_hap = (labels == labels[0]).tolist();
+	if sum(new_hap) == len(variants):
 		output = "";
-		for xvar in variants:
-			if xvar+":0" in new_hap:
+		for xvar in range(0, len(variants)):
+			if new_hap[2 * xvar]:
 				output += "0";
-			elif xvar+":1" in new_hap:
+			elif new_hap[(2 * xvar) + 1]:
 				output += "1";
 		return([[output,inverse_conifg(output)]]);
 	else:
@@ -2214,48 +2779,56 @@ def sub_block_phase(variants, allele_connections, sub_block_configs=[], attempt_
 		configurations += [sub_block_configs[0][0] + sub_block_configs[1][1]];
 		configurations += [sub_block_configs[0][1] + sub_block_configs[1][0]];
 		configurations += [sub_block_configs[0][1] + sub_block_configs[1][1]];
+
+		# only test each haplotype once, not necessary to test complement
+		test_configs = [];
+		for configuration in configurations:
+			if configuration not in test_configs and inverse_conifg(configuration) not in test_configs:
+				test_configs.append(configuration);
+
+		# alleles as 0 / 1, -1 where unknown
+		configurations = numpy.array([[-1 if x == "-" else int(x) for x in config] for config in test_configs], dtype=numpy.int8);
 	else:
 		# first try to resolve phase
 		if attempt_resolve == True:
-			xhap = resolve_phase(variants, allele_connections, clean_connections = True);
+			xhap = resolve_phase(variants, allele_connections);
 			if xhap != None:
 				return(xhap[0]);
 
 		# otherwise determine all possible configurations in this block
-		configurations = ["".join(seq) for seq in itertools.product("01", repeat=len(variants))];
+		# a complement has the same support, so only those with the first variant's allele 0 are tested
+		config_bits = numpy.arange(len(variants) - 1)[::-1];
+		configurations = (numpy.arange(2 ** (len(variants) - 1))[:, None] >> config_bits) & 1;
+		configurations = numpy.column_stack([numpy.zeros(len(configurations), dtype=numpy.int8), configurations]).astype(numpy.int8);
 
-	supporting_connections = collections.OrderedDict()
-	set_variants = set(variants);
-
-	for configuration in configurations:
-		inverse_config = inverse_conifg(configuration);
-		# only test each haplotype once, not necessary to test complement
-		if configuration + "|" + inverse_config not in supporting_connections and inverse_config + "|" + configuration not in supporting_connections:
-			support = 0;
-			for variant, allele in zip(variants, configuration):
-				if allele != "-":
-					if variant+":"+allele in allele_connections:
-						for other_variant, other_allele in zip(variants, configuration):
-							if other_variant != variant:
-								if other_allele != "-":
-									if other_variant+":"+other_allele in allele_connections[variant+":"+allele]:
-										support += 1;
-
-			supporting_connections[configuration + "|" + inverse_config] = support;
+	support = configuration_support(configurations, variants[0], allele_connections);
 
 	# select connections with maximum support
-	max_support = max(supporting_connections.values());
-
-	best_configs = [];
-	for config in supporting_connections.keys():
-		if supporting_connections[config] == max_support:
-			best_configs.append(config);
+	best_configs = numpy.flatnonzero(support == support.max());
 
 	if len(best_configs) == 1:
-		return(best_configs[0].split("|"));
+		best_config = "".join(["-" if x < 0 else str(x) for x in configurations[best_configs[0]].tolist()]);
+		return([best_config, inverse_conifg(best_config)]);
 	else:
 		return(["-"*len(variants),"-"*len(variants)]);
 
+def configuration_support(configurations, first_variant, allele_connections):
+	# number of connections between the alleles chosen in each configuration, counted from both alleles of each connection
+	first_node = 2 * first_variant;
+	last_node = 2 * (first_variant + configurations.shape[1]);
+	links = allele_connections[first_node:last_node, first_node:last_node].tocoo();
+	var_a = links.row // 2;
+	var_b = links.col // 2;
+	allele_a = links.row % 2;
+	allele_b = links.col % 2;
+
+	support = numpy.zeros(len(configurations), dtype=numpy.int64);
+	for start in range(0, len(configurations), 4096):
+		chunk = configurations[start:start+4096];
+		support[start:start+4096] = ((chunk[:, var_a] == allele_a) & (chunk[:, var_b] == allele_b)).sum(axis=1);
+
+	return(support);
+
 def inverse_conifg(config):
 	out_config = "";
 
@@ -2308,17 +2881,14 @@ def split_variants(variants, split_points):
 def find_weak_points(variants, variant_connections):
 	# this function reports how many connections are crossing each point, where a point is between a pair of variants
 	# it returns a dictionary with the counts at each point
+	# connections are on local indexes, each is counted once from its left variant
+	links = scipy.sparse.triu(variant_connections, k=1).tocoo();
+	crossing = numpy.cumsum(numpy.bincount(links.row + 1, minlength=len(variants) + 1) - numpy.bincount(links.col + 1, minlength=len(variants) + 1)).tolist();
 
 	dict_counts = collections.OrderedDict()
 
 	for position in range(2,len(variants)-1):
-		dict_counts[position] = 0;
-
-		for xvar in variant_connections:
-			for connection in variant_connections[xvar]:
-				# check if variant spans position
-				if variants.index(xvar) < (position - 0.5) and variants.index(connection) > (position - 0.5):
-					dict_counts[position] += 1;
+		dict_counts[position] = crossing[position];
 
 	return(dict_counts);
 
@@ -1,6 +1,231 @@
 import sys;
+import time;
+import bisect;
+import collections;
+import struct;
+import numpy;
+import pysam;
+
+# mapping results are written as fixed size binary records, one per read variant overlap
+# variant = row of the variant in the variant table, read = index of the read name in the .reads file written alongside
+# bam = index of the BAM the read came from, allele = index of the read allele in the variant's alleles, -1 if it matches none of them
+result_dtype = numpy.dtype([('variant','<u4'),('read','<u4'),('bam','<u2'),('allele','i1'),('as','<i4')]);
+result_struct = struct.Struct("<IIHbi");
+# alignment score recorded for reads without an AS tag
+as_missing = -2147483648;
+
+# metrics kept for each bam mapped into an output, see README for descriptions
+metric_names = ["reads_fetched","filtered_unmapped","filtered_dup","filtered_pair","filtered_mapq","filtered_isize","filtered_splice","reads_mapped","overlaps_no_allele","hits_written","peak_window","peak_dup_held","map_seconds","wall_seconds"];
+
+# alignment files opened by this process, kept open so CRAM reference slices decoded for one shard are reused by the next
+alignment_files = {};
 
 def do_read_variant_map(variant_table, baseq, o, splice, isize_cutoff):
+	# map SAM formatted reads streamed through stdin
+	set_args(variant_table, baseq, o, splice, isize_cutoff);
+
+	contigs = [];
+
+	def stream_reads():
+		for line in sys.stdin:
+			read_columns = line.rstrip().split("\t");
+			# first read the order of chromosomes
+			if read_columns[0][0:3] == "@SQ":
+				contigs.append(read_columns[1].split(":")[1]);
+			elif read_columns[0][0:1] != "@" and read_columns[9] != "*":
+				#ERR188213.33037635	355	1	11673	3	76M	=	11784	352	TGAAGCCCTGGAGATTCTTATTAGTGATTTGGGCTGGGGCCTGGCCATGTGTATTTTTTTAAATTTCCACTGATGA	C@CAFFFFHHHDHFHFE>HHHIJICHIGIGGGIEEHIEGGFFHGHIGFGFAB9BFHGIIEFFDFFFFFDCCEEEEA	PG:Z:MarkDuplicates	RG:Z:id	NH:i:2	HI:i:2	nM:i:0	AS:i:152
+				alignment_score = as_missing;
+				for i in range(11,len(read_columns)):
+					if read_columns[i].startswith("AS:"):
+						alignment_score = int(read_columns[i].split(":")[2]);
+						break;
+
+				yield([read_columns[0], read_columns[2], int(read_columns[3]), abs(int(read_columns[8])), read_columns[9], [ord(x) - 33 for x in read_columns[10]], parse_cigar(read_columns[5]), alignment_score]);
+
+	output = open_output(o);
+	map_reads(stream_reads(), contigs, True, output);
+	close_output(output);
+
+def do_read_variant_map_bam(bams, chrom, start, intervals, variant_table, variant_offset, variant_row, baseq, o, splice, remove_dups, reference):
+	# map reads fetched directly from indexed BAM or CRAM files, applying the read filters in process
+	# bams is a list of [bam, mapq, isize_cutoff, paired_end], all of them are mapped into one result with hits tagged by bam index
+	# a bam is None if it has no reads on the chromosome, and is skipped
+	# reference is the FASTA used to decode CRAM files, "" to use the reference given in the CRAM header
+	# returns the alignment score histogram and the metrics of each bam
+	# reads are fetched through the index from the sorted, non overlapping [start, stop) intervals around the variants of this window
+	# reads starting before start were mapped with the previous window, so that windows of a chromosome can be mapped independently
+	# variant_offset and variant_row are the file position and row in the variant table of the first variant of the window
+	set_args(variant_table, baseq, o, splice, 0);
+	args['variant_offset'] = variant_offset;
+	args['variant_row'] = variant_row;
+
+	output = open_output(o, len(bams));
+
+	for bam_index in range(0, len(bams)):
+		if bams[bam_index] == None:
+			continue;
+
+		bam, mapq, isize_cutoff, paired_end = bams[bam_index];
+		args['bam_index'] = bam_index;
+		args['isize_cutoff'] = isize_cutoff;
+
+		bam_in = open_alignment_file(bam, reference);
+		map_reads(fetch_reads(bam_in, chrom, start, intervals, mapq, remove_dups, paired_end, output[4][bam_index]), list(bam_in.references), False, output);
+
+	close_output(output);
+
+	return([output[3], output[4]]);
+
+def open_alignment_file(path, reference):
+	# returns the open handle for a BAM or CRAM file, opening it on first use in this process
+	global alignment_files;
+
+	if (path, reference) not in alignment_files:
+		alignment_files[(path, reference)] = new_alignment_file(path, reference);
+
+	return(alignment_files[(path, reference)]);
+
+def new_alignment_file(path, reference):
+	if path.endswith(".cram"):
+		if reference != "":
+			return(pysam.AlignmentFile(path, "rc", reference_filename=reference));
+		else:
+			return(pysam.AlignmentFile(path, "rc"));
+	else:
+		return(pysam.AlignmentFile(path, "rb"));
+
+def mapped_contigs(path, reference):
+	# contigs that have mapped reads according to the index, or all contigs if the index has no read counts
+	# CRAM indices have no read counts, they report every contig as empty, so all of their contigs are used
+	bam_in = new_alignment_file(path, reference);
+	contigs = set(bam_in.references);
+	if bam_in.is_cram == False:
+		try:
+			index_statistics = bam_in.get_index_statistics();
+			if sum([x.total for x in index_statistics]) > 0:
+				contigs = set([x.contig for x in index_statistics if x.mapped > 0]);
+		except (AttributeError, ValueError, NotImplementedError):
+			pass;
+	bam_in.close();
+
+	return(contigs);
+
+def close_alignment_files():
+	global alignment_files;
+
+	for bam_in in alignment_files.values():
+		bam_in.close();
+	alignment_files = {};
+
+def fetch_reads(bam_in, chrom, start, intervals, mapq, remove_dups, paired_end, metrics):
+	# reads of a window of one BAM that pass the read filters, in the form used by map_reads
+	# remove_dups = 1 removes reads flagged as duplicates, 2 also detects unflagged duplicates among the fetched reads
+	if remove_dups == 2:
+		reads = remove_duplicates(filter_reads(bam_in, chrom, start, intervals, mapq, 1, paired_end, metrics), metrics);
+	else:
+		reads = filter_reads(bam_in, chrom, start, intervals, mapq, remove_dups, paired_end, metrics);
+
+	for read in reads:
+		if read.has_tag("AS"):
+			alignment_score = read.get_tag("AS");
+		else:
+			alignment_score = as_missing;
+
+		yield([read.query_name, chrom, read.reference_start + 1, abs(read.template_length), read.query_sequence, read.query_qualities, read.cigartuples, alignment_score]);
+
+def filter_reads(bam_in, chrom, start, intervals, mapq, remove_dups, paired_end, metrics):
+	# a read belongs to the first interval it overlaps, reads that start before the end of the previous interval also overlap it
+	# so they have already been fetched, this keeps reads spanning several intervals from being mapped twice and reads in position order
+	previous_stop = start;
+
+	for interval_start, interval_stop in intervals:
+		for read in bam_in.fetch(chrom, interval_start, interval_stop):
+			if read.reference_start < previous_stop:
+				continue;
+			metrics['reads_fetched'] += 1;
+			if read.is_unmapped or read.query_sequence == None or read.query_qualities == None:
+				metrics['filtered_unmapped'] += 1;
+				continue;
+			if remove_dups == 1 and read.is_duplicate:
+				metrics['filtered_dup'] += 1;
+				continue;
+			if paired_end == 1 and read.is_proper_pair == False:
+				metrics['filtered_pair'] += 1;
+				continue;
+			if read.mapping_quality < mapq:
+				metrics['filtered_mapq'] += 1;
+				continue;
+
+			yield(read);
+
+		previous_stop = interval_stop;
+
+def remove_duplicates(reads, metrics):
+	# duplicates share their unclipped 5' position, which can be up to a read length away from where they start aligning
+	# so reads are held until the fetched position has passed their 5' position by the longest read seen
+	# at that point every read that could be a duplicate of them has been fetched
+	# reads are released in the order they came, so a read also waits for every read fetched before it
+	# the 5' position of a reverse strand read is its alignment end, so the reads held can span the reference length of a read
+	# including any introns it is spliced across, not only a read length, the peak number held is reported in the metrics
+	# of each set of duplicates the read with the lowest name is kept, this picks the same template for both mates of a pair
+	held = collections.deque();
+	kept = {};
+	held_keys = {};
+	window = 0;
+
+	for read in reads:
+		window = max(window, read.infer_read_length());
+		key = duplicate_key(read);
+		if key not in kept or read.query_name < kept[key].query_name:
+			kept[key] = read;
+		held_keys[key] = held_keys.get(key, 0) + 1;
+		held.append((key, read));
+		if len(held) > metrics['peak_dup_held']: metrics['peak_dup_held'] = len(held);
+
+		while held[0][0][1] < read.reference_start - window:
+			release_key, release_read = held.popleft();
+			if release_read is kept[release_key]:
+				yield(release_read);
+			else:
+				metrics['filtered_dup'] += 1;
+			held_keys[release_key] -= 1;
+			if held_keys[release_key] == 0:
+				del held_keys[release_key];
+				del kept[release_key];
+
+	for release_key, release_read in held:
+		if release_read is kept[release_key]:
+			yield(release_read);
+		else:
+			metrics['filtered_dup'] += 1;
+
+def duplicate_key(read):
+	# strand, unclipped 5' position and, for pairs, the unclipped 5' position and strand of the mate
+	# the mate position is taken from its MC tag when there is one, otherwise its alignment start is used
+	five_prime = unclipped_five_prime(read.reference_start, read.cigartuples, read.is_reverse);
+
+	if read.is_paired and read.mate_is_unmapped == False:
+		if read.has_tag("MC"):
+			mate_five_prime = unclipped_five_prime(read.next_reference_start, parse_cigar(read.get_tag("MC")), read.mate_is_reverse);
+		else:
+			mate_five_prime = read.next_reference_start;
+		return((read.is_reverse, five_prime, read.is_read1, read.next_reference_id, mate_five_prime, read.mate_is_reverse));
+	else:
+		return((read.is_reverse, five_prime));
+
+def unclipped_five_prime(reference_start, cigar, is_reverse):
+	if is_reverse:
+		five_prime = reference_start + sum([x[1] for x in cigar if x[0] in (0,2,3,7,8)]);
+		if cigar[-1][0] in (4,5): five_prime += cigar[-1][1];
+		if len(cigar) > 1 and cigar[-1][0] == 5 and cigar[-2][0] == 4: five_prime += cigar[-2][1];
+	else:
+		five_prime = reference_start;
+		if cigar[0][0] in (4,5): five_prime -= cigar[0][1];
+		if len(cigar) > 1 and cigar[0][0] == 5 and cigar[1][0] == 4: five_prime -= cigar[1][1];
+
+	return(five_prime);
+
+def set_args(variant_table, baseq, o, splice, isize_cutoff):
 	global args;
 	args = {};
 	args['variant_table'] = variant_table;
@@ -8,123 +233,156 @@ def do_read_variant_map(variant_table, baseq, o, splice, isize_cutoff):
 	args['o'] = o;
 	args['splice'] = splice;
 	args['isize_cutoff'] = isize_cutoff;
-	
-	stream_out = open(args['o'], "w");
-	stream_variants = open(args['variant_table'],"r");
-	#[output['chr'],str(output['pos']-1),str(output['pos']),output['id']
+	args['variant_offset'] = 0;
+	args['variant_row'] = 0;
+	args['bam_index'] = 0;
+
+def open_output(o, bam_count=1):
+	# [results, read names, index of each read name written, alignment score histogram of each bam, metrics of each bam]
+	# read names are written once and referred to by index in the results, across all the BAMs mapped into the output
+	# alignment scores are small integers, so an exact histogram {score:count} of the hits is kept to compute cutoffs from
+	return([open(o, "wb"), open(o+".reads", "w"), {}, [{} for x in range(0, bam_count)], [new_metrics() for x in range(0, bam_count)]]);
+
+def new_metrics():
+	metrics = {};
+	for name in metric_names:
+		metrics[name] = 0;
+	return(metrics);
+
+def close_output(output):
+	output[0].close();
+	output[1].close();
+
+def map_reads(reads, contigs, print_progress, output):
+	# reads must be coordinate sorted, each read is [name, chr, pos, template_length, bases, baseqs, cigar, alignment_score]
+	# baseqs are integers and cigar is a list of (operation, length) tuples
+	global args;
+
+	stream_out, stream_read_names, read_index, as_histograms, bam_metrics = output;
+	bam_index = args['bam_index'];
+	as_histogram = as_histograms[bam_index];
+	metrics = bam_metrics[bam_index];
+	wall_start = time.time();
+	stream_variants = variant_stream(args['variant_table'], args['variant_offset'], args['variant_row']);
+
+	# rank of each contig in the BAM, used to seek through the variant table
+	contig_rank = {};
+	for i in range(0, len(contigs)):
+		contig_rank[contigs[i]] = i;
 
-	contigs = [];
-	
 	line_variant = get_next_variant(stream_variants);
 
-	variant_buffer = [];
-	as_column = -1;
+	# position sorted window of variants on the current read chromosome
+	# variants behind window_start can no longer be overlapped by any read and are evicted
+	window_pos = [];
+	window_vars = [];
+	window_start = 0;
+	window_chr = None;
 
 	read_counter = 0;
-	
-	for line in sys.stdin:
-		# first read the order of chromosomes
-		read_columns = line.rstrip().split("\t");
-		if read_columns[0][0:3] == "@SQ":
-			contigs.append(line.rstrip().split("\t")[1].split(":")[1]);
-		elif read_columns[0][0:1] != "@":
-			#ERR188213.33037635	355	1	11673	3	76M	=	11784	352	TGAAGCCCTGGAGATTCTTATTAGTGATTTGGGCTGGGGCCTGGCCATGTGTATTTTTTTAAATTTCCACTGATGA	C@CAFFFFHHHDHFHFE>HHHIJICHIGIGGGIEEHIEGGFFHGHIGFGFAB9BFHGIIEFFDFFFFFDCCEEEEA	PG:Z:MarkDuplicates	RG:Z:id	NH:i:2	HI:i:2	nM:i:0	AS:i:152	
-			halt = 0;
-			read_chr = read_columns[2];
-			read_pos = int(read_columns[3]);
-			template_length = abs(int(read_columns[8]));
-			
-			# clear variant buffer
-			buffer_remove = [];
-			for variant_i in range(0, len(variant_buffer)):
-				if variant_buffer[variant_i].chr != read_chr:
-					# remove variants from buffer that are from previous chromosomes
-					if contigs.index(variant_buffer[variant_i].chr) < contigs.index(read_chr):
-						buffer_remove.append(variant_i);
-				elif variant_buffer[variant_i].pos < read_pos:
-					# remove variants from buffer that are behind the minimum read position on the current chromosome
-					buffer_remove.append(variant_i);
-			
-			for index in reversed(buffer_remove):
-				del variant_buffer[index];
-			
-			if (args['isize_cutoff'] == 0 or template_length <= args['isize_cutoff']):
-				# get the AS
-				alignment_score = "";
-		
-				if as_column == -1:
-					for i in range(11,len(read_columns)):
-						if read_columns[i].startswith("AS:"):
-							alignment_score = int(read_columns[i].split(":")[2]);
-							as_column = i;
-				else:
-					alignment_score = int(read_columns[as_column].split(":")[2]);
-				
-				#Set as_column back to initial value, in case not all reads have equal number fields
-				as_column = -1;
-		
-				# BAM and variant not on same chromosome
-				if line_variant != None:
-					if line_variant.chr != read_chr:
-						if line_variant.chr not in contigs:
-							print("Error, VCF and BAM contigs do not match VCF = %s BAM = %s"%(line_variant.chr,read_chr));
-							sys.exit(1)
+
+	for read in reads:
+		# time spent outside of the loop body is spent fetching and decoding reads
+		map_start = time.time();
+		#[read_name, read_chr, read_pos, template_length, bases, baseqs, cigar, alignment_score]
+		read_chr = read[1];
+		read_pos = read[2];
+		template_length = read[3];
+
+		if read_chr != window_chr:
+			# new chromosome, clear the window and seek the variants to this chromosome
+			window_pos = [];
+			window_vars = [];
+			window_start = 0;
+			window_chr = read_chr;
+
+			while line_variant != None and line_variant.chr != read_chr:
+				if line_variant.chr not in contig_rank:
+					raise RuntimeError("Error, VCF and BAM contigs do not match VCF = %s BAM = %s"%(line_variant.chr,read_chr));
+				if contig_rank[line_variant.chr] > contig_rank[read_chr]:
+					# variants are ahead of the reads, wait for the BAM to catch up
+					break;
+				line_variant = get_next_variant(stream_variants);
+
+		# remove variants from the window that are behind the minimum read position
+		window_start = bisect.bisect_left(window_pos, read_pos, window_start);
+		if window_start > 1000 and window_start * 2 > len(window_pos):
+			del window_pos[:window_start];
+			del window_vars[:window_start];
+			window_start = 0;
+
+		if args['isize_cutoff'] != 0 and template_length > args['isize_cutoff']:
+			metrics['filtered_isize'] += 1;
+		else:
+			alignment_score = read[7];
+
+			# seek the variants
+			while line_variant != None and line_variant.chr == read_chr and line_variant.pos < read_pos:
+				line_variant = get_next_variant(stream_variants);
+
+			alignments = split_read(read_pos, read[6]);
+			if len(alignments) == 0:
+				metrics['filtered_splice'] += 1;
+			else:
+				metrics['reads_mapped'] += 1;
+
+			for alignment in alignments:
+				alignment_start = alignment.genome_start;
+				alignment_end = alignment.genome_end;
+
+				# extend the window up to the end of this alignment
+				while line_variant != None and line_variant.chr == read_chr and line_variant.pos <= alignment_end:
+					window_pos.append(line_variant.pos);
+					window_vars.append(line_variant);
+					line_variant = get_next_variant(stream_variants);
+
+				# only test the variants that fall within the alignment
+				first = bisect.bisect_left(window_pos, alignment_start, window_start);
+				last = bisect.bisect_right(window_pos, alignment_end, first);
+
+				for xvar in window_vars[first:last]:
+					allele = identify_allele(alignment, read[4], read[5], xvar);
+					if allele != "":
+						if read[0] not in read_index:
+							read_index[read[0]] = len(read_index);
+							stream_read_names.write(read[0]+"\n");
+
+						if allele in xvar.alleles:
+							allele_code = xvar.alleles.index(allele);
 						else:
-							vindex = contigs.index(line_variant.chr);
-							bindex = contigs.index(read_chr);
-				
-							if vindex < bindex:
-								# need to seek in variants
-								while line_variant.chr != read_chr:
-									line_variant = get_next_variant(stream_variants);
-									if line_variant == None:
-										break;
-							elif bindex > vindex:
-								# need to seek bam
-								halt = 1;
-		
-				# variant file and BAM are on the same chromosome
-				if halt == 0:
-					if line_variant != None:
-						if line_variant.pos < read_pos:
-							# seek the variants
-							while line_variant.pos < read_pos and line_variant.chr == read_chr:
-								line_variant = get_next_variant(stream_variants);
-								if line_variant == None:
-									break;
-					
-					alignments = split_read(read_pos, read_columns[9],read_columns[10],read_columns[5], read_columns[0]);
-					
-					for alignment in alignments:
-						
-						intersected_variants = []
-						for variant_i in range(0, len(variant_buffer)):
-							if variant_buffer[variant_i].pos >= (alignment.read_start + read_pos) and variant_buffer[variant_i].pos <= (alignment.read_start + read_pos)+len(alignment.pseudo_read):
-								# otherwise record an intersection
-								intersected_variants.append(variant_buffer[variant_i]);
-					
-						if line_variant != None:
-							while line_variant.pos <= (alignment.read_start + read_pos)+len(alignment.pseudo_read) and line_variant.chr == read_chr:
-								intersected_variants.append(line_variant);
-								variant_buffer.append(line_variant);
-								line_variant = get_next_variant(stream_variants);
-								if line_variant == None:
-									break;
-				
-						for xvar in variant_buffer:
-							allele = identify_allele(alignment, read_pos, xvar);
-							if allele != "":
-								stream_out.write("\t".join([read_columns[0],xvar.id,xvar.rs_id,allele,str(alignment_score),xvar.genotype,xvar.maf])+"\n");
-					
-					
+							allele_code = -1;
+
+						stream_out.write(result_struct.pack(xvar.row, read_index[read[0]], bam_index, allele_code, alignment_score));
+						metrics['hits_written'] += 1;
+						if alignment_score != as_missing:
+							as_histogram[alignment_score] = as_histogram.get(alignment_score, 0) + 1;
+					else:
+						metrics['overlaps_no_allele'] += 1;
+
+				if len(window_pos) - window_start > metrics['peak_window']: metrics['peak_window'] = len(window_pos) - window_start;
+
 		read_counter += 1;
-		
-		if read_counter%100000 == 0:
-			print("               processed %d reads, buffer_size = %d, position = %s:%d"%(read_counter,len(variant_buffer),read_chr,read_pos));
-	stream_out.close();
-	
+		metrics['map_seconds'] += time.time() - map_start;
+
+		if print_progress == True and read_counter%100000 == 0:
+			print("               processed %d reads, buffer_size = %d, position = %s:%d"%(read_counter,len(window_pos)-window_start,read_chr,read_pos));
+	stream_variants.close();
+
+	metrics['wall_seconds'] += time.time() - wall_start;
+
+def load_mapping_result(path):
+	# returns the binary mapping records as a numpy structured array, and the list of read names they refer to
+	records = numpy.fromfile(path, dtype=result_dtype);
+
+	stream_in = open(path+".reads", "r");
+	read_names = stream_in.read().split("\n")[:-1];
+	stream_in.close();
+
+	return([records, read_names]);
+
 class variant:
-	def __init__(self, variant_columns):
+	def __init__(self, variant_columns, row):
+		self.row = row;
 		self.chr = variant_columns[0]
 		self.pos = int(variant_columns[1]);
 		self.id = variant_columns[2];
@@ -138,121 +396,142 @@ class variant:
 		return("\t".join(map(str,[self.chr,self.pos,self.id])));
 				
 class alignment:
+	# a spliced block of a read, coordinates are 1 based and genome_end is exclusive
 	def __init__(self, input):
-		self.read_start = input[0]
-		self.read_stop = input[1];
-		self.pseudo_read = input[2];
+		self.genome_start = input[0];
+		self.genome_end = input[1];
+		# aligned (M/=/X) blocks as [genome_start, genome_end, read_offset]
+		self.blocks = input[2];
+		# inserted bases as genome position of the preceding base : [read_offset, length]
 		self.insertions = input[3];
-		self.read_pos = input[4];
-		self.read_id = input[5];
-		
-	def genome_start(self):
-		return(self.read_pos + self.read_start);
-	
+
+	def read_offset(self, genome_pos):
+		# offset in the read of the base aligned to genome_pos, None if it is deleted
+		for block in self.blocks:
+			if genome_pos >= block[0] and genome_pos < block[1]:
+				return(block[2] + (genome_pos - block[0]));
+		return(None);
+
 	def __str__(self):
-		return("\t".join(map(str,[self.read_start,self.read_stop,self.pseudo_read,self.insertions,self.read_pos])));
+		return("\t".join(map(str,[self.genome_start,self.genome_end,self.blocks,self.insertions])));
+
+class variant_stream:
+	# reads the variant table sequentially, keeping track of the row of each variant
+	def __init__(self, path, offset, row):
+		self.stream = open(path, "r");
+		self.stream.seek(offset);
+		self.row = row;
+
+	def close(self):
+		self.stream.close();
 
 def get_next_variant(stream_variants):
-	buffer = stream_variants.readline();
+	buffer = stream_variants.stream.readline();
 	if buffer != "":
-		xvar = variant(buffer.rstrip().split("\t"));
+		xvar = variant(buffer.rstrip().split("\t"), stream_variants.row);
+		stream_variants.row += 1;
 	else:
 		xvar = None;
 		#print("               completed mapping reads...")
-	
+
 	return(xvar);
 
-def split_read(alignment_pos, bases,baseqs,cigar, read_id):
+cigar_operations = {"M":0, "I":1, "D":2, "N":3, "S":4, "H":5, "P":6, "=":7, "X":8};
+
+def parse_cigar(cigar):
+	# convert a CIGAR string to a list of (operation, length) tuples using the BAM operation codes
+	cigar_tuples = [];
+	number_build = "";
+	for c in cigar:
+		ascii = ord(c);
+		if ascii >= 48 and ascii <= 57:
+			#number;
+			number_build += c;
+		else:
+			if c in cigar_operations:
+				cigar_tuples.append((cigar_operations[c], int(number_build)));
+			number_build = "";
+
+	return(cigar_tuples);
+
+def split_read(alignment_pos, cigar):
 	global args;
-	
+
 	alignments = [];
-	
-	if args['splice'] == 1 or "N" not in cigar:
-		#first filter read by BASEQ
-		number_build = "";
-		read_seq = "";
+
+	if args['splice'] == 1 or 3 not in [x[0] for x in cigar]:
+		# walk the CIGAR once, recording where each aligned block sits in the read
 		read_pos = 0;
-	
-		genome_start = 0;
-		genome_pos = 0;
-	
-		for base, quality in zip(bases, baseqs):
-			baseq = ord(quality) - 33;
-			if baseq >= args['baseq']:
-				read_seq += base;
-			else:
-				read_seq += "N";
-		
-		bases = read_seq;
-		
-		aligned_bases = 0;
-		pseudo_read = "";
+		genome_pos = alignment_pos;
+		genome_start = genome_pos;
+
+		blocks = [];
 		insertions = {};
-		for c in cigar:
-			ascii = ord(c);
-			if ascii >= 48 and ascii <= 57:
-				#number;
-				number_build += c;
-			else:
-				seq_len = int(number_build);
-				if c == "M" or c == "X" or c == "=":
-					#alignment
-					pseudo_read += bases[read_pos:read_pos+seq_len];
-					read_pos += seq_len;
-					aligned_bases += seq_len;
-					genome_pos += seq_len;
-				
-				elif c == "N":
-					#gap
-					alignments.append(alignment([genome_start,genome_pos,pseudo_read,insertions,alignment_pos,read_id]));
-					genome_pos += seq_len;
-					genome_start = genome_pos;
-					pseudo_read = "";
-					insertions = {};
-					
-				elif c == "D":
-					#deletion
-					pseudo_read += "D" * seq_len;
-					genome_pos += seq_len;
-					
-				elif c == "I":
-					#insertion
-					insertions[genome_pos-1] = bases[read_pos:read_pos+seq_len];
-					read_pos += seq_len;
-					
-				elif c == "S":
-					#clipped, not used in alignment
-					read_pos += seq_len;
-
-				elif c == "H":
-					#hard-clipped, advance neither on read nor reference
-					pass
-
-				number_build = "";
-		alignments.append(alignment([genome_start,genome_pos,pseudo_read,insertions,alignment_pos,read_id]));
-	
+		for operation, seq_len in cigar:
+			if operation == 0 or operation == 7 or operation == 8:
+				#alignment
+				blocks.append([genome_pos, genome_pos+seq_len, read_pos]);
+				read_pos += seq_len;
+				genome_pos += seq_len;
+
+			elif operation == 3:
+				#gap
+				alignments.append(alignment([genome_start,genome_pos,blocks,insertions]));
+				genome_pos += seq_len;
+				genome_start = genome_pos;
+				blocks = [];
+				insertions = {};
+
+			elif operation == 2:
+				#deletion
+				genome_pos += seq_len;
+
+			elif operation == 1:
+				#insertion
+				insertions[genome_pos-1] = [read_pos, seq_len];
+				read_pos += seq_len;
+
+			elif operation == 4:
+				#clipped, not used in alignment
+				read_pos += seq_len;
+
+			#hard-clipped and padding, advance neither on read nor reference
+
+		alignments.append(alignment([genome_start,genome_pos,blocks,insertions]));
+
 	return(alignments);
 
-def identify_allele(alignment, read_coord, xvar):
-	map_start = alignment.genome_start();
-	
-	read_start = (xvar.pos)-map_start;
-	read_end = (xvar.pos+xvar.ref_length)-map_start;
-	
-	if read_start >= 0 and read_end <= len(alignment.pseudo_read):
-		read_seq = alignment.pseudo_read[read_start:read_end]
-		
-		offset = 0;
-		for genome_pos in range(read_start,read_end):
-			#print(genome_pos);
-			if genome_pos in alignment.insertions:
-				insert_pos = (genome_pos - read_start) + offset + 1;
-				read_seq = read_seq[0:insert_pos] + alignment.insertions[genome_pos] + read_seq[insert_pos:len(read_seq)];
-				offset += len(alignment.insertions[genome_pos]);
-		
-		#remove deletion placeholder
-		read_seq = read_seq.replace("D","");
-		if read_seq != "N":
-			return(read_seq);
-	
+def identify_allele(alignment, bases, baseqs, xvar):
+	# bases with a base quality below the cutoff are read as N
+	if xvar.pos < alignment.genome_start or xvar.pos+xvar.ref_length > alignment.genome_end:
+		return("");
+
+	if xvar.ref_length == 1 and xvar.pos not in alignment.insertions:
+		# single base, no need to build a string
+		offset = alignment.read_offset(xvar.pos);
+		if offset == None or baseqs[offset] < args['baseq'] or bases[offset] == "N":
+			return("");
+		return(bases[offset]);
+
+	read_seq = "";
+	for genome_pos in range(xvar.pos, xvar.pos+xvar.ref_length):
+		offset = alignment.read_offset(genome_pos);
+		# deleted bases are not included in the allele
+		if offset != None:
+			read_seq += masked_bases(bases, baseqs, offset, 1);
+		if genome_pos in alignment.insertions:
+			read_seq += masked_bases(bases, baseqs, alignment.insertions[genome_pos][0], alignment.insertions[genome_pos][1]);
+
+	if read_seq != "N":
+		return(read_seq);
+
 	return("");
+
+def masked_bases(bases, baseqs, offset, length):
+	read_seq = "";
+	for i in range(offset, offset+length):
+		if baseqs[i] >= args['baseq']:
+			read_seq += bases[i];
+		else:
+			read_seq += "N";
+	return(read_seq);
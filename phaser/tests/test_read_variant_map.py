@@ -0,0 +1,177 @@
+import os;
+import sys;
+import shutil;
+import random;
+import tempfile;
+import unittest;
+import pysam;
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."));
+import read_variant_map;
+
+header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 100000}]});
+
+def new_read(name, start, cigar, is_reverse, mate=None):
+	read = pysam.AlignedSegment(header);
+	read.query_name = name;
+	read.reference_id = 0;
+	read.reference_start = start;
+	read.cigarstring = cigar;
+	length = read.infer_query_length();
+	read.query_sequence = "A" * length;
+	read.query_qualities = pysam.qualitystring_to_array("I" * length);
+	read.is_reverse = is_reverse;
+	if mate != None:
+		mate_start, mate_cigar, mate_is_reverse = mate;
+		read.is_paired = True;
+		read.is_read1 = True;
+		read.next_reference_id = 0;
+		read.next_reference_start = mate_start;
+		read.mate_is_reverse = mate_is_reverse;
+		if mate_cigar != None:
+			read.set_tag("MC", mate_cigar);
+	return(read);
+
+def remove_duplicates(reads):
+	metrics = dict([(x, 0) for x in read_variant_map.metric_names]);
+	reads = sorted(reads, key=lambda x: x.reference_start);
+	kept = [x.query_name for x in read_variant_map.remove_duplicates(iter(reads), metrics)];
+	return([kept, metrics['filtered_dup']]);
+
+class remove_duplicates_test(unittest.TestCase):
+	def test_soft_clipped_forward(self):
+		# 5' end 1000 for both
+		kept, dups = remove_duplicates([new_read("b", 1000, "100M", False), new_read("a", 1005, "5S95M", False)]);
+		self.assertEqual(kept, ["a"]);
+		self.assertEqual(dups, 1);
+
+	def test_reverse_different_length(self):
+		# 5' end 2100 for both
+		kept, dups = remove_duplicates([new_read("a", 2000, "100M", True), new_read("b", 2010, "10S90M", True)]);
+		self.assertEqual(kept, ["a"]);
+		self.assertEqual(dups, 1);
+
+	def test_clipped_and_reverse_together(self):
+		reads = [new_read("f1", 1000, "100M", False), new_read("f2", 1005, "5S95M", False), new_read("r1", 2000, "100M", True), new_read("r2", 2010, "10S90M", True), new_read("f3", 1500, "100M", False)];
+		kept, dups = remove_duplicates(reads);
+		self.assertEqual(kept, ["f1", "f3", "r1"]);
+		self.assertEqual(dups, 2);
+
+	def test_strand_differs(self):
+		kept, dups = remove_duplicates([new_read("a", 1000, "100M", False), new_read("b", 900, "100M", True)]);
+		self.assertEqual(kept, ["b", "a"]);
+		self.assertEqual(dups, 0);
+
+	def test_mate_clipped_position(self):
+		# mates align at different starts but share their unclipped 5' end according to the MC tag
+		reads = [new_read("b", 1000, "100M", False, [1300, "100M", True]), new_read("a", 1000, "100M", False, [1310, "10S90M", True])];
+		kept, dups = remove_duplicates(reads);
+		self.assertEqual(kept, ["a"]);
+		self.assertEqual(dups, 1);
+
+	def test_mate_position_differs(self):
+		reads = [new_read("b", 1000, "100M", False, [1300, "100M", True]), new_read("a", 1000, "100M", False, [1300, "90M", True])];
+		kept, dups = remove_duplicates(reads);
+		self.assertEqual(kept, ["b", "a"]);
+		self.assertEqual(dups, 0);
+
+def read_alleles(pos, cigar, bases, alleles, baseqs=None):
+	read_variant_map.set_args("", 10, "", 1, 0);
+	if baseqs == None:
+		baseqs = [40] * len(bases);
+	xvar = read_variant_map.variant(["chr1", pos, "v", "v", alleles, len(alleles.split(",")[0]), "0|1", "0"], 0);
+	return([read_variant_map.identify_allele(x, bases, baseqs, xvar) for x in read_variant_map.split_read(101, read_variant_map.parse_cigar(cigar))]);
+
+class identify_allele_test(unittest.TestCase):
+	def test_snv_before_insertion(self):
+		# base 105 is followed by 2 inserted bases, which are part of the read allele so it matches neither allele
+		self.assertEqual(read_alleles(105, "5M2I10M", "AAAAGTTCCCCCCCCCC", "A,G"), ["GTT"]);
+
+	def test_spliced_snv_before_insertion(self):
+		# second block starts at 211, base 215 is followed by 2 inserted bases
+		self.assertEqual(read_alleles(215, "10M100N5M2I10M", "CCCCCCCCCCAAAAGTTCCCCCCCCCC", "A,G"), ["", "GTT"]);
+
+	def test_insertion(self):
+		self.assertEqual(read_alleles(105, "5M2I10M", "AAAAGTTCCCCCCCCCC", "G,GTT"), ["GTT"]);
+
+	def test_n_base(self):
+		self.assertEqual(read_alleles(105, "15M", "AAAANCCCCCCCCCC", "A,G"), [""]);
+
+	def test_low_quality_base(self):
+		self.assertEqual(read_alleles(105, "15M", "AAAAGCCCCCCCCCC", "A,G", [40] * 4 + [5] + [40] * 10), [""]);
+
+class cram_test(unittest.TestCase):
+	# the same reads as a BAM and a CRAM, with an indexed reference, over two contigs with a het site each
+	@classmethod
+	def setUpClass(cls):
+		cls.path = tempfile.mkdtemp();
+		rng = random.Random(1);
+		contigs = [["chr1", "".join([rng.choice("ACGT") for x in range(0, 2000)])], ["chr2", "".join([rng.choice("ACGT") for x in range(0, 2000)])]];
+
+		cls.reference = os.path.join(cls.path, "ref.fa");
+		stream_out = open(cls.reference, "w");
+		for name, seq in contigs:
+			stream_out.write(">%s\n%s\n"%(name, seq));
+		stream_out.close();
+		pysam.faidx(cls.reference);
+
+		# het site at 1 based position 1001 of each contig, reads alternate between the ref and alt allele
+		cls.variant_table = os.path.join(cls.path, "variants.txt");
+		stream_out = open(cls.variant_table, "w");
+		for name, seq in contigs:
+			alt = "A" if seq[1000] != "A" else "C";
+			stream_out.write("\t".join([name, "1001", name+"_1001", ".", seq[1000]+","+alt, "1", "0|1", "None", "0"])+"\n");
+		stream_out.close();
+
+		contig_header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': x[0], 'LN': len(x[1])} for x in contigs]});
+		cls.bam = os.path.join(cls.path, "reads.bam");
+		cls.cram = os.path.join(cls.path, "reads.cram");
+		outs = [pysam.AlignmentFile(cls.bam, "wb", header=contig_header), pysam.AlignmentFile(cls.cram, "wc", header=contig_header, reference_filename=cls.reference)];
+		for contig_index, (name, seq) in enumerate(contigs):
+			for i in range(0, 20):
+				start = 950 + i;
+				bases = list(seq[start:start+100]);
+				if i % 2 == 1: bases[1000 - start] = "A" if seq[1000] != "A" else "C";
+				read = pysam.AlignedSegment(contig_header);
+				read.query_name = "%s_%d"%(name, i);
+				read.reference_id = contig_index;
+				read.reference_start = start;
+				read.mapping_quality = 60;
+				read.cigarstring = "100M";
+				read.query_sequence = "".join(bases);
+				read.query_qualities = pysam.qualitystring_to_array("I" * 100);
+				for out in outs:
+					out.write(read);
+		for out in outs:
+			out.close();
+		pysam.index(cls.bam);
+		pysam.index(cls.cram);
+
+	@classmethod
+	def tearDownClass(cls):
+		read_variant_map.close_alignment_files();
+		shutil.rmtree(cls.path);
+
+	def map_contig(self, path, contig):
+		# row and table offset of the contig's variant
+		variant_row = [x.split("\t")[0] for x in open(self.variant_table)].index(contig);
+		variant_offset = sum([len(x) for x in open(self.variant_table).readlines()[:variant_row]]);
+		o = os.path.join(self.path, "result_%s_%s"%(os.path.basename(path), contig));
+		read_variant_map.do_read_variant_map_bam([[path, 0, 0, 0]], contig, 0, [[0, 2000]], self.variant_table, variant_offset, variant_row, 10, o, 1, 0, self.reference);
+		records, read_names = read_variant_map.load_mapping_result(o);
+		return(sorted([(read_names[x['read']], int(x['variant']), int(x['allele'])) for x in records]));
+
+	def test_mapped_contigs(self):
+		self.assertEqual(read_variant_map.mapped_contigs(self.bam, self.reference), set(["chr1", "chr2"]));
+		self.assertEqual(read_variant_map.mapped_contigs(self.cram, self.reference), set(["chr1", "chr2"]));
+
+	def test_cram_matches_bam(self):
+		for row, contig in enumerate(["chr1", "chr2"]):
+			bam_hits = self.map_contig(self.bam, contig);
+			self.assertEqual(len(bam_hits), 20);
+			self.assertEqual(sorted(set([x[2] for x in bam_hits])), [0, 1]);
+			self.assertEqual(set([x[1] for x in bam_hits]), set([row]));
+			self.assertEqual(self.map_contig(self.cram, contig), bam_hits);
+
+if __name__ == "__main__":
+	unittest.main();